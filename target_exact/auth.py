@@ -1,25 +1,42 @@
 import json
+import os
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Any, Dict, Optional
 
 import logging
+import threading
 import requests
 import backoff
 
+from target_exact import tracing
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
 
 class ExactAuthenticator:
     """API Authenticator for OAuth 2.0 flows."""
 
+    # Exact rotates the refresh token on every refresh, so only one thread (and,
+    # through a lock file next to the config, one process) may refresh at a
+    # time; the others pick up the new token from the config
+    refresh_lock = threading.Lock()
+
     def __init__(
         self,
         target,
         state,
         auth_endpoint: Optional[str] = None,
+        timeout=None,
     ) -> None:
         """Init authenticator.
 
         Args:
             stream: A stream for a RESTful endpoint.
+            timeout: (connect, read) timeout of the token request.
         """
         self.target_name: str = target.name
         self._config: Dict[str, Any] = target._config
@@ -30,11 +47,15 @@ class ExactAuthenticator:
         self._config_file = target.config_file
         self._target = target
         self.state = state
+        self.timeout = timeout
 
     @property
     def auth_headers(self) -> dict:
         if not self.is_token_valid():
-            self.update_access_token()
+            with self.refresh_lock, self.config_file_lock():
+                self.reload_token()
+                if not self.is_token_valid():
+                    self.update_access_token()
         result = {}
         result["Authorization"] = f"Bearer {self._config.get('access_token')}"
         return result
@@ -49,6 +70,29 @@ class ExactAuthenticator:
             "client_secret": self._config["client_secret"],
         }
 
+    @contextmanager
+    def config_file_lock(self):
+        if fcntl is None or not isinstance(self._config_file, (str, os.PathLike)):
+            yield
+            return
+        with open(f"{self._config_file}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def reload_token(self) -> None:
+        # another process sharing the config file may have refreshed the token
+        try:
+            with open(self._config_file) as f:
+                config = json.load(f)
+        except (OSError, TypeError, ValueError):
+            return
+        if int(config.get("expires_in") or 0) > int(self._config.get("expires_in") or 0):
+            for key in ["access_token", "refresh_token", "expires_in"]:
+                self._config[key] = config.get(key)
+
     def is_token_valid(self) -> bool:
         access_token = self._config.get("access_token")
         now = round(datetime.utcnow().timestamp())
@@ -67,9 +111,12 @@ class ExactAuthenticator:
     def update_access_token(self) -> None:
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         self.logger.info(f"Oauth request - endpoint: {self._auth_endpoint}, body: {self.oauth_request_body}")
-        token_response = requests.post(
-            self._auth_endpoint, data=self.oauth_request_body, headers=headers
-        )
+        with tracing.span("token refresh", endpoint=self._auth_endpoint) as span:
+            token_response = requests.post(
+                self._auth_endpoint, data=self.oauth_request_body, headers=headers, timeout=self.timeout
+            )
+            if span:
+                span.set("http.status_code", token_response.status_code)
 
         try:
             if (
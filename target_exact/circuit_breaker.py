@@ -0,0 +1,100 @@
+"""Per-endpoint circuit breakers, failing requests fast while Exact is degraded."""
+import re
+import threading
+import time
+from collections import deque
+
+from target_exact.exceptions import CircuitOpenError
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+# entity keys and the like, e.g. /crm/Accounts(guid'...') is /crm/Accounts
+ENTITY_KEY = re.compile(r"\(.*\)$")
+
+
+class CircuitBreaker:
+    """Tracks the outcome of the last `window` requests to one endpoint.
+
+    Once at least `min_calls` of them are known and `failure_rate` of them
+    failed (5xx, timeouts and connection errors), the circuit opens and
+    requests fail with `CircuitOpenError` without being sent. After
+    `open_seconds` one trial request is let through (half-open): if it
+    succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=20, open_seconds=60, logger=None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def retry_after(self):
+        return max(0.0, self.opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self):
+        """Raise `CircuitOpenError` unless a request to the endpoint may be sent now."""
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and self.retry_after() == 0:
+                self.transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return
+            retry_after = self.retry_after() or self.open_seconds
+        raise CircuitOpenError(f"Circuit for {self.name} is {self.state}, failing fast", retry_after)
+
+    def record(self, success):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if not self.trial_in_flight:
+                    # a request sent before the circuit opened
+                    return
+                self.trial_in_flight = False
+                if success:
+                    self.outcomes.clear()
+                    self.transition(CLOSED)
+                else:
+                    self.open()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if (
+                self.state == CLOSED
+                and len(self.outcomes) >= self.min_calls
+                and failures >= self.failure_rate * len(self.outcomes)
+            ):
+                self.open()
+
+    def open(self):
+        self.opened_at = time.monotonic()
+        self.transition(OPEN)
+
+    def transition(self, state):
+        if self.logger and state != self.state:
+            self.logger.warning(f"Circuit for {self.name}: {self.state} -> {state}")
+        self.state = state
+
+
+class CircuitBreakers:
+    """The circuit breakers of a run, one per division (base URL) and endpoint."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def get(self, base_url, endpoint):
+        key = (base_url, ENTITY_KEY.sub("", endpoint.split("?")[0]))
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker("".join(key), **self.options)
+            return self.breakers[key]
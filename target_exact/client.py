@@ -5,11 +5,39 @@ from singer_sdk.plugin_base import PluginBase
 from typing import Dict, List, Optional
 from target_exact.auth import ExactAuthenticator
 import backoff
+import logging
 import requests
 from singer_sdk.exceptions import FatalAPIError, RetriableAPIError
 import xmltodict
 import re
 import ast
+import threading
+import contextlib
+import copy
+import hashlib
+import os
+import time
+from urllib.parse import parse_qs, urlparse
+from target_exact.lookups import EntityIndex, same_value
+from target_exact.mapping import format_datetime, is_datetime_property
+from target_exact.metadata import compile_validators, parse_metadata
+from target_exact.exceptions import (
+    CircuitOpenError,
+    InvalidReferenceError,
+    MissingEntityKeyError,
+    PartialDocumentError,
+    PayloadValidationError,
+)
+from target_exact.dead_letters import DeadLetterQueue
+from target_exact.pipeline import RecordPipeline
+from target_exact.hedging import HedgedRequests
+from target_exact.circuit_breaker import CircuitBreakers
+from target_exact.concurrency import AdaptiveConcurrency
+from target_exact import tracing
+from target_exact.explain import DRY_RUN_ID, DryRunResponse
+
+# (connect, read) timeouts in seconds, overridable per method with `timeouts`
+DEFAULT_TIMEOUTS = {"GET": (10, 60), "POST": (10, 300), "PUT": (10, 300)}
 
 class ExactSink(HotglueSink):
 
@@ -23,9 +51,66 @@ class ExactSink(HotglueSink):
         """Initialize target sink."""
         self._target = target
         super().__init__(target, stream_name, schema, key_properties)
+        self.datetime_properties = [
+            key for key, property in schema.get("properties", {}).items() if is_datetime_property(property)
+        ]
+
+        self.dead_letters = None
+        # bookmarks of the dead-lettered records, in queue order
+        self.dead_letter_bookmarks = []
+        # set on the thread of a write that nothing of has been sent yet
+        self.deferrable = threading.local()
+        if self.config.get("dead_letter_dir"):
+            path = os.path.join(self.config["dead_letter_dir"], f"{self.name}.jsonl")
+            self.dead_letters = DeadLetterQueue(path)
+            self.send_record = self.upsert_record
+            # the SDK calls self.upsert_record, route it through the queue
+            self.upsert_record = self.upsert_or_dead_letter
+
+        if self.config.get("hedge_lookups") and self._target.hedger is None:
+            self._target.hedger = HedgedRequests(
+                max_hedge_rate=float(self.config.get("hedge_max_rate", 0.05))
+            )
+
+        if self.config.get("circuit_breaker") and self._target.circuit_breakers is None:
+            self._target.circuit_breakers = CircuitBreakers(
+                failure_rate=float(self.config.get("circuit_failure_rate", 0.5)),
+                min_calls=int(self.config.get("circuit_min_calls", 10)),
+                window=int(self.config.get("circuit_window", 20)),
+                open_seconds=float(self.config.get("circuit_open_seconds", 60)),
+                logger=self.logger,
+            )
+
+        if self.config.get("adaptive_concurrency") and self._target.concurrency is None:
+            min_limit = int(self.config.get("min_concurrency", 1))
+            self._target.concurrency = AdaptiveConcurrency(
+                initial=int(self.config.get("initial_concurrency", min_limit)),
+                min_limit=min_limit,
+                max_limit=int(self.config.get("max_concurrency", self._target.MAX_PARALLELISM)),
+                interval=float(self.config.get("concurrency_interval", 5)),
+                latency_tolerance=float(self.config.get("concurrency_latency_tolerance", 2)),
+                logger=self.logger,
+            )
+
+        self.pipeline = None
+        if int(self.config.get("pipeline_depth", 0)) > 0 and not self.explain:
+            self.pipeline = RecordPipeline(self.write_queued_record, int(self.config["pipeline_depth"]))
 
     auth_state = {}
 
+    # key property of the entities the sink creates
+    key_property = "ID"
+
+    # (payload key, line endpoint, document key on the line) used to split
+    # documents with too many lines over several requests
+    document_lines = None
+
+    # payload fields holding GUIDs of other entities, "Lines.Field" for line items
+    references = {}
+
+    # fields `lookup_id` resolves per endpoint, bulk-loaded together with `prefetch_lookups`
+    lookup_fields = {}
+
     @property
     def current_division(self):
         return self.config.get("current_division")
@@ -52,17 +137,22 @@ class ExactSink(HotglueSink):
         if not oauth_url.endswith("/token"):
             oauth_url += "/token"
         return ExactAuthenticator(
-            self._target, self.auth_state, oauth_url
+            self._target, self.auth_state, oauth_url, timeout=self.timeout("POST")
         )
     
     @property
     def default_warehouse_uuid(self) -> str:
+        if self.explain:
+            self.explain.count("lookups", self.name)
+            return DRY_RUN_ID
         if self.config.get("default_warehouse_id") and not self.config.get("warehouse_uuid"):
             default_warehouse_id = self.config.get("default_warehouse_id")
             url=f"{self.base_url}/inventory/Warehouses"
             params={"$filter": f"Code eq '{default_warehouse_id}'"}
             headers=self.authenticator.auth_headers
-            response = requests.request("GET", url=url, params=params,headers=headers)
+            response = self.session.request(
+                "GET", url=url, params=params, headers=headers, timeout=self.timeout("GET")
+            )
             self.validate_response(response)
             res_json = xmltodict.parse(response.text)
             try:
@@ -81,28 +171,91 @@ class ExactSink(HotglueSink):
         headers.update(self.authenticator.auth_headers or {})
         return headers
 
-    @backoff.on_exception(
-        backoff.expo,
-        (RetriableAPIError, requests.exceptions.ReadTimeout),
-        max_tries=5,
-        factor=2,
-    )
+    @property
+    def session(self) -> requests.Session:
+        # one connection pool for all sinks (and, in the daemon, all jobs)
+        if self._target.session is None:
+            self._target.session = requests.Session()
+        return self._target.session
+
+    def concurrency_slot(self, endpoint):
+        if self._target.concurrency:
+            return self._target.concurrency.slot(endpoint)
+        return contextlib.nullcontext({})
+
+    def max_tries(self, http_method):
+        # the first request of a write that can be dead-lettered is retried at
+        # the end of the run instead of blocking the sink; once part of the
+        # record is written (e.g. a document's header) it is retried inline
+        if http_method != "GET" and getattr(self.deferrable, "write", False):
+            self.deferrable.write = False
+            return int(self.config.get("dead_letter_inline_tries", 1))
+        return 5
+
     def _request(
         self, http_method, endpoint, params=None, request_data=None, headers=None
-    ) -> requests.PreparedRequest:
-        """Prepare a request object."""
+    ) -> requests.Response:
+        """Send a request, retrying transient failures with exponential backoff."""
+        send = backoff.on_exception(
+            backoff.expo,
+            (RetriableAPIError, requests.exceptions.Timeout),
+            max_tries=self.max_tries(http_method),
+            factor=2,
+            on_backoff=self.trace_retry_sleep,
+        )(self._send_request)
+        # other threads process their records while this one waits on the API
+        with self._target.shared_state.released():
+            return send(http_method, endpoint, params, request_data, headers)
+
+    def trace_retry_sleep(self, details):
+        tracing.add_span("retry sleep", details["wait"], tries=details["tries"], endpoint=details["args"][1])
+
+    def timeout(self, http_method):
+        timeouts = {**DEFAULT_TIMEOUTS, **(self.config.get("timeouts") or {})}
+        return tuple(timeouts.get(http_method, DEFAULT_TIMEOUTS["POST"]))
+
+    def _send_request(
+        self, http_method, endpoint, params=None, request_data=None, headers=None
+    ) -> requests.Response:
         url = self.url(endpoint)
-        headers = self.http_headers
-
-        response = requests.request(
-            method=http_method,
-            url=url,
-            params=params,
-            headers=headers,
-            json=request_data,
-        )
-        self.validate_response(response)
-        return response
+        headers = {**self.http_headers, **(headers or {})}
+
+        breaker = None
+        if self._target.circuit_breakers:
+            breaker = self._target.circuit_breakers.get(self.base_url, endpoint)
+
+        def send():
+            # checked per attempt, so the retries stop once the circuit opens
+            if breaker:
+                breaker.allow()
+            healthy = False
+            try:
+                self._target.rate_limits.wait()
+                with self.concurrency_slot(endpoint) as outcome, \
+                        tracing.span(f"HTTP {http_method}", endpoint=endpoint) as span:
+                    response = self.session.request(
+                        method=http_method,
+                        url=url,
+                        params=params,
+                        headers=headers,
+                        json=request_data,
+                        timeout=self.timeout(http_method),
+                    )
+                    outcome["status"] = response.status_code
+                    # 4xx (and 429) are answers of a working endpoint
+                    healthy = response.status_code < 500
+                    if span:
+                        span.set("http.status_code", response.status_code)
+                    self._target.rate_limits.update(response.headers)
+                    self.validate_response(response)
+                    return response
+            finally:
+                if breaker:
+                    breaker.record(healthy)
+
+        if http_method == "GET" and self._target.hedger:
+            return self._target.hedger.send(send)
+        return send()
 
 
     def validate_input(self, record: dict):
@@ -120,6 +273,18 @@ class ExactSink(HotglueSink):
             # This is the format -> "2022-08-15T19:16:35Z"
             return date.strftime("%Y-%m-%dT%H:%M:%SZ")
         return date
+
+    def _parse_timestamps_in_record(self, record: dict, schema: dict, treatment) -> None:
+        # the SDK parses date-time properties into datetimes, which the sinks
+        # then format again; normalize them straight to Exact's format instead
+        try:
+            for key in self.datetime_properties:
+                value = record.get(key)
+                if value is not None:
+                    record[key] = format_datetime(value)
+        except (ValueError, OverflowError):
+            # invalid timestamps are handled by the SDK according to `treatment`
+            super()._parse_timestamps_in_record(record, schema, treatment)
     
     def validate_response(self, response: requests.Response) -> None:
         """Validate HTTP response."""
@@ -141,9 +306,18 @@ class ExactSink(HotglueSink):
                 msg = self.response_error_message(response)
             raise FatalAPIError(msg)
     
+    @property
+    def explain(self):
+        return self._target.explain
+
     def request_api(self, http_method, endpoint=None, params={}, request_data=None, headers={}):
         """Request records from REST endpoint(s), returning response records."""
         self.logger.info(f"REQUEST - endpoint: {endpoint}, request_body: {request_data}")
+        if self.explain:
+            self.explain.count("lookups" if http_method == "GET" else "writes", self.name)
+            return DryRunResponse(http_method)
+        if http_method == "POST":
+            self.validate_payload(endpoint, request_data)
         resp = self._request(http_method, endpoint, params, request_data, headers)
         return resp
     
@@ -153,16 +327,430 @@ class ExactSink(HotglueSink):
         except:
             return json.loads(obj)
     
+    def create_entity(self, endpoint, payload, key_property=None):
+        """POST a new entity and return its key.
+
+        With `minimal_responses` set, Exact is asked not to echo the created
+        entity back and the key is read from the Location header instead. The
+        full entity is still requested when debug logging is enabled. The
+        entity is not POSTed again when a minimal response lacks its key, as
+        that would create it twice.
+        """
+        key_property = key_property or self.key_property
+        minimal = self.config.get("minimal_responses") and not self.logger.isEnabledFor(logging.DEBUG)
+        headers = {"Prefer": "return=minimal"} if minimal else {}
+        response = self.request_api("POST", endpoint=endpoint, request_data=payload, headers=headers)
+
+        if minimal:
+            # e.g. https://start.exactonline.nl/api/v1/1/salesorder/SalesOrders(guid'...')
+            location = response.headers.get("Location") or response.headers.get("DataServiceId") or ""
+            key = re.search(r"\(guid'([0-9a-fA-F-]+)'\)", location)
+            if key:
+                return key.group(1)
+            if not response.text:
+                raise MissingEntityKeyError(
+                    f"{endpoint} created an entity but its minimal response has no key in a Location or "
+                    f"DataServiceId header (status {response.status_code}); turn off minimal_responses"
+                )
+        self.logger.debug(f"response from api: {response.text}")
+        res_json = xmltodict.parse(response.text)
+        return res_json["entry"]["content"]["m:properties"][f"d:{key_property}"]["#text"]
+
+    def split_lines(self, lines):
+        """Split line items into the lines sent with the header and the rest."""
+        max_lines = int(self.config.get("max_lines_per_request", 500))
+        max_bytes = int(self.config.get("max_request_bytes", 1_000_000))
+        size = 0
+        for count, line in enumerate(lines):
+            size += len(json.dumps(line, default=str))
+            if count >= max_lines or (count and size > max_bytes):
+                return lines[:count], lines[count:]
+        return lines, []
+
+    def create_document(self, endpoint, payload):
+        """Create a document, appending its lines separately when it is too large.
+
+        The header is POSTed with the lines that fit in `max_lines_per_request`
+        and `max_request_bytes`; the remaining lines are POSTed to the line
+        endpoint one by one, as its entity set takes one entity per request.
+        """
+        if not self.document_lines:
+            return self.create_entity(endpoint, payload)
+        lines_key, line_endpoint, document_key = self.document_lines
+        # all lines are checked before the header exists
+        self.validate_payload(endpoint, payload)
+        lines, remaining = self.split_lines(payload.get(lines_key) or [])
+        if not remaining:
+            return self.create_entity(endpoint, payload)
+
+        self.logger.info(f"{self.name} has {len(lines) + len(remaining)} lines, appending {len(remaining)} separately")
+        id = self.create_entity(endpoint, {**payload, lines_key: lines})
+        for sent, line in enumerate(remaining, len(lines)):
+            try:
+                self.request_api("POST", endpoint=line_endpoint, request_data={**line, document_key: id})
+            except Exception as e:
+                # don't let the whole document be retried, the header exists
+                raise PartialDocumentError(
+                    f"{self.name} {id} was created with {sent} of {len(lines) + len(remaining)} lines: {e}"
+                )
+        return id
+
     def get_id(self, endpoint, filter):
-        res = self.request_api("GET", endpoint=f"{endpoint}", params=filter)
-        res_json = xmltodict.parse(res.text)
-        results = res_json["feed"].get("entry")
+        with tracing.span("get_id", endpoint=endpoint, filter=filter.get("$filter")) as span:
+            res = self.request_api("GET", endpoint=f"{endpoint}", params=filter)
+            res_json = xmltodict.parse(res.text)
+            results = res_json["feed"].get("entry")
+
+            if results and len(results):
+                if type(results) is dict:
+                    id = results["content"]["m:properties"]["d:ID"]["#text"]
+                else:
+                    id = results[0]["content"]["m:properties"]["d:ID"]["#text"]
+                return id
+            else:
+                if span:
+                    span.set("found", False)
+                return None
+
+    def entry_properties(self, entry):
+        # flatten an Atom entry into {"ID": ..., "Code": ...}; typed and null
+        # properties come back from xmltodict as dicts
+        properties = entry["content"]["m:properties"]
+        return {
+            key.split(":", 1)[-1]: value.get("#text") if isinstance(value, dict) else value
+            for key, value in properties.items()
+        }
+
+    def get_all(self, endpoint, params=None):
+        """Page through an entity set, yielding the properties of every entry."""
+        params = dict(params or {})
+        while True:
+            res = self.request_api("GET", endpoint=endpoint, params=params)
+            feed = xmltodict.parse(res.text)["feed"]
+            entries = feed.get("entry") or []
+            if type(entries) is dict:
+                entries = [entries]
+            for entry in entries:
+                yield self.entry_properties(entry)
+
+            links = feed.get("link") or []
+            if type(links) is dict:
+                links = [links]
+            next_link = next((link for link in links if link.get("@rel") == "next"), None)
+            if not next_link:
+                return
+            skiptoken = parse_qs(urlparse(next_link["@href"]).query).get("$skiptoken")
+            if not skiptoken:
+                return
+            params["$skiptoken"] = skiptoken[0]
+
+    def get_index(self, endpoint, fields, value_fields=()):
+        """Return the shared index for an entity set, loading it in bulk on first use."""
+        indexes = self._target.lookup_indexes
+        key = (self.base_url, endpoint)
+        if self.explain:
+            # the size of the entity set is unknown without calling the API,
+            # count one page and let lookups go through `get_id`
+            if key not in indexes:
+                self.explain.count("bulk_loads", self.name)
+                indexes[key] = EntityIndex(fields, value_fields)
+            return indexes[key]
+        # read once, streams on other threads may replace the index meanwhile
+        index = indexes.get(key)
+        if index is not None and (
+            index.complete
+            and set(fields) <= set(index.fields)
+            and set(value_fields) <= set(index.value_fields)
+        ):
+            return index
+        if index is not None:
+            # reload with the union of the fields asked for so far
+            fields = list(dict.fromkeys([*index.fields, *fields]))
+            value_fields = list(dict.fromkeys([*index.value_fields, *value_fields]))
 
-        if results and len(results):
-            if type(results) is dict:
-                id = results["content"]["m:properties"]["d:ID"]["#text"]
+        def load():
+            snapshot_path = None
+            if self.config.get("index_snapshot_dir") and not value_fields:
+                snapshot_path = self.index_snapshot_path(endpoint)
+                max_age = float(self.config.get("index_snapshot_max_age", 3600))
+                index = EntityIndex.open_snapshot(snapshot_path, fields, max_age)
+                if index is not None:
+                    self.logger.info(f"Opened lookup index snapshot of {endpoint} ({len(index)} entities)")
+                    return index
+
+            index = EntityIndex(fields, value_fields, complete=True)
+            params = {"$select": ",".join(dict.fromkeys(["ID", *fields, *value_fields]))}
+            for entity in self.get_all(endpoint, params):
+                index.add(entity)
+            self.logger.info(f"Loaded {len(index)} entities from {endpoint} into lookup index")
+            if snapshot_path:
+                # serve lookups from the mapped file, shared with other processes
+                index.save_snapshot(snapshot_path)
+                index = EntityIndex.open_snapshot(snapshot_path) or index
+            return index
+
+        load_key = ("index", *key, tuple(fields), tuple(value_fields))
+        with self._target.shared_state.released():
+            index = self._target.in_flight.do(load_key, load)
+        indexes[key] = index
+        return index
+
+    def index_snapshot_path(self, endpoint):
+        key = hashlib.sha1(f"{self.base_url}{endpoint}".encode()).hexdigest()[:12]
+        name = endpoint.strip("/").replace("/", "_")
+        return os.path.join(self.config["index_snapshot_dir"], f"{name}-{key}.idx")
+
+    def validate_references(self, payload):
+        """Check the GUIDs in `references` against the cached indexes before POSTing.
+
+        Only runs when `validate_references` is set, since it loads every
+        referenced entity set in bulk. Records with unknown references are
+        appended to `quarantine_path` (if set) and rejected.
+        """
+        if not self.config.get("validate_references") or not payload or self.explain:
+            return
+        for path, endpoint in self.references.items():
+            index = self.get_index(endpoint, [])
+            field, _, line_field = path.partition(".")
+            values = payload.get(field)
+            if line_field:
+                values = [line.get(line_field) for line in values or []]
             else:
-                id = results[0]["content"]["m:properties"]["d:ID"]["#text"]
+                values = [values]
+            for value in values:
+                if value and value not in index:
+                    error = f"{path} {value} does not exist in {endpoint}"
+                    self.quarantine(error, payload)
+                    raise InvalidReferenceError(error)
+
+    def quarantine(self, error, payload):
+        quarantine_path = self.config.get("quarantine_path")
+        if quarantine_path:
+            with open(quarantine_path, "a") as f:
+                f.write(json.dumps({"stream": self.name, "error": error, "record": payload}, default=str) + "\n")
+
+    def validate_payload(self, endpoint, payload):
+        """Check a payload against the $metadata of its entity set before POSTing it.
+
+        Only runs when `validate_payloads` is set. Types, max lengths (or, with
+        `truncate_strings`, cutting strings to them), non-nullable and required
+        properties are checked by validators compiled once per service, so
+        invalid records cost no API call. They are quarantined and rejected.
+        """
+        if not self.config.get("validate_payloads") or self.explain or not isinstance(payload, dict):
+            return
+        service, _, entity_set = endpoint.strip("/").partition("/")
+        validate = self.get_validators(service).get(entity_set)
+        if validate is None:
+            return
+        errors = validate(payload, bool(self.config.get("truncate_strings")))
+        if errors:
+            error = f"{entity_set} payload is invalid: {'; '.join(errors)}"
+            self.quarantine(error, payload)
+            raise PayloadValidationError(error)
+
+    def get_validators(self, service):
+        key = (urlparse(self.base_url).netloc, service)
+        validators = self._target.metadata.get(key)
+        if validators is None:
+            def load():
+                try:
+                    entity_sets = parse_metadata(self.fetch_metadata(service))
+                except Exception as e:
+                    self.logger.warning(f"Could not load the $metadata of {service}, not validating its payloads: {e}")
+                    return {}
+                return compile_validators(
+                    entity_sets, self.config.get("required_properties"), self.config.get("max_lengths")
+                )
+
+            with self._target.shared_state.released():
+                validators = self._target.in_flight.do(("metadata", *key), load)
+            self._target.metadata[key] = validators
+        return validators
+
+    def fetch_metadata(self, service):
+        """Download the $metadata document of a service, cached in `metadata_cache_dir` if set."""
+        path = None
+        if self.config.get("metadata_cache_dir"):
+            path = os.path.join(self.config["metadata_cache_dir"], f"{service}-{urlparse(self.base_url).netloc}.xml")
+            max_age = float(self.config.get("metadata_max_age", 86400))
+            if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+                with open(path) as f:
+                    return f.read()
+        text = self._request("GET", f"/{service}/$metadata").text
+        if path:
+            with open(f"{path}.{os.getpid()}.tmp", "w") as f:
+                f.write(text)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
+        return text
+
+    def diff_upsert(self, payload, match_fields, value_fields):
+        """Create the entity, or PUT only the fields that differ from the existing one.
+
+        Existing entities are matched on the first of `match_fields` present in
+        the payload, against an index of the entity set loaded in bulk with the
+        current `value_fields`. Returns the entity ID and the state updates;
+        unchanged entities cost no request.
+        """
+        index = self.get_index(self.endpoint, match_fields, value_fields)
+        matches = (index.get(field, payload[field]) for field in match_fields if payload.get(field))
+        id = next((match for match in matches if match), None)
+
+        if not id:
+            id = self.create_entity(self.endpoint, payload, "ID")
+            self.remember_entity(self.endpoint, {"ID": id, **payload})
+            self.logger.info(f"{self.name} created with id: {id}")
+            return id, {}
+
+        current = index.get_values(id)
+        changes = {
+            field: value for field, value in payload.items()
+            if not same_value(current.get(field), value)
+        }
+        if not changes:
+            self.logger.info(f"{self.name} {id} is unchanged, skipping")
+            return id, {}
+        self.request_api("PUT", endpoint=f"{self.endpoint}(guid'{id}')", request_data=changes)
+        current.update(changes)
+        self.logger.info(f"{self.name} {id} updated fields: {list(changes)}")
+        return id, {"is_updated": True}
+
+    def remember_entity(self, endpoint, entity):
+        """Write an entity created or looked up during the run through to the shared index."""
+        key = (self.base_url, endpoint)
+        index = self._target.lookup_indexes.setdefault(key, EntityIndex())
+        index.add(entity)
+
+    def lookup_id(self, endpoint, field, value):
+        """Return the ID of the entity whose `field` equals `value`.
+
+        Served from the shared index when possible (with `prefetch_lookups`,
+        the whole entity set is loaded in bulk first); misses are looked up
+        with `get_id` and remembered for the rest of the run.
+        """
+        if value is None:
+            return None
+        if self.explain:
+            self.explain.count("lookups_cold", self.name)
+        if self.config.get("prefetch_lookups") and not self.explain:
+            fields = self.lookup_fields.get(endpoint, [])
+            index = self.get_index(endpoint, fields if field in ("ID", *fields) else [*fields, field])
+        else:
+            index = self._target.lookup_indexes.get((self.base_url, endpoint))
+        if index is not None:
+            id = index.get(field, value)
+            if id or index.is_complete(field):
+                return id
+
+        if field == "ID":
+            filter = f"ID eq guid'{value}'"
+        else:
+            filter = f"{field} eq '{value}'"
+
+        def lookup():
+            id = self.get_id(endpoint, {"$filter": filter})
+            if id:
+                self.remember_entity(endpoint, {"ID": id, field: value})
             return id
+
+        # threads looking up the same entity share one request
+        with self._target.shared_state.released():
+            return self._target.in_flight.do((self.base_url, endpoint, filter), lookup)
+
+    def upsert_or_dead_letter(self, record: dict, context: dict):
+        # the sinks edit the payload while they send it
+        letter = copy.deepcopy(record)
+        self.deferrable.write = True
+        try:
+            return self.send_record(record, context)
+        except (RetriableAPIError, requests.exceptions.RequestException, CircuitOpenError) as e:
+            self.dead_letters.add(letter, repr(e))
+            self.logger.warning(f"{self.name} record deferred to the dead letter queue: {e}")
+            return None, False, {"deferred": True, "error": f"Deferred for retry: {e}"}
+        finally:
+            self.deferrable.write = False
+
+    def retry_dead_letters(self):
+        """Re-send the dead-lettered records at `dead_letter_retry_interval` seconds apart.
+
+        The outcome is recorded on the bookmark each record got when it was
+        deferred, so the state holds one bookmark per record.
+        """
+        letters = self.dead_letters.drain()
+        bookmarks, self.dead_letter_bookmarks = self.dead_letter_bookmarks, []
+        if not letters:
+            return
+        self.logger.info(f"Retrying {len(letters)} dead-lettered {self.name} records")
+        interval = float(self.config.get("dead_letter_retry_interval", 1))
+        failed = []
+        for letter, bookmark in zip(letters, bookmarks):
+            time.sleep(interval)
+            del bookmark["deferred"], bookmark["error"]
+            try:
+                id, success, state_updates = self.resend_record(letter["record"])
+                self.settle_bookmark(bookmark, success, id=id, retried=True, **(state_updates or {}))
+            except Exception as e:
+                self.dead_letters.add(letter["record"], repr(e))
+                self.settle_bookmark(bookmark, False, error=str(e), retried=True)
+                failed.append(letter["record"])
+
+        self.logger.info(
+            f"Dead letter retry for {self.name}: {len(letters) - len(failed)} succeeded, "
+            f"{len(failed)} failed"
+        )
+        if failed:
+            self.logger.error(f"{self.name} records that finally failed (kept in {self.dead_letters.path}): {failed}")
+
+    def resend_record(self, record):
+        try:
+            return self.send_record(copy.deepcopy(record), {})
+        except CircuitOpenError as e:
+            # wait for the endpoint's trial request rather than failing the rest of the queue
+            time.sleep(e.retry_after)
+            return self.send_record(copy.deepcopy(record), {})
+
+    def settle_bookmark(self, bookmark, success, **updates):
+        """Record the outcome of a write that finished after its bookmark was added as failed."""
+        summary = self.latest_state["summary"][self.name]
+        summary["fail"] -= 1
+        if not success:
+            summary["fail"] += 1
+        elif updates.pop("is_updated", False):
+            summary["updated"] += 1
         else:
-            return None
+            summary["success"] += 1
+        bookmark["success"] = success
+        bookmark.update(updates)
+
+    def write_record(self, record: dict, context: dict) -> None:
+        # upsert the record and add its bookmark
+        super().process_record(record, context)
+        if self.dead_letters is not None:
+            bookmark = self.latest_state["bookmarks"][self.name][-1]
+            if bookmark.get("deferred"):
+                self.dead_letter_bookmarks.append(bookmark)
+
+    def write_queued_record(self, record: dict, context: dict) -> None:
+        # on the pipeline's thread, which updates the state alongside the SDK's
+        with self._target.shared_state.held():
+            self.write_record(record, context)
+
+    def process_record(self, record: dict, context: dict) -> None:
+        if self.pipeline:
+            # a full queue waits on the pipeline's thread, which needs the lock
+            with self._target.shared_state.released():
+                self.pipeline.put(record, context)
+        else:
+            self.write_record(record, context)
+
+    def flush(self) -> None:
+        """Finish the writes the sink holds back, called before the target copies the state."""
+        if self.pipeline:
+            with self._target.shared_state.released():
+                self.pipeline.join()
+
+    def clean_up(self) -> None:
+        if self.pipeline:
+            self.pipeline.close()
+            self.pipeline = None
+        super().clean_up()
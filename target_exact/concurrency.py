@@ -0,0 +1,142 @@
+"""Adaptive limit on the number of requests in flight (AIMD)."""
+import json
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from target_exact.circuit_breaker import ENTITY_KEY
+
+
+class EndpointStats:
+    """Outcomes of the requests to one endpoint during one control interval."""
+
+    __slots__ = ("requests", "latency", "throttled", "errors")
+
+    def __init__(self):
+        self.requests = 0
+        self.latency = 0.0
+        self.throttled = 0
+        self.errors = 0
+
+
+class AdaptiveConcurrency:
+    """Caps the requests in flight at a limit adjusted every `interval` seconds.
+
+    Per endpoint, the mean latency of the interval is compared with the
+    lowest one seen so far (its baseline). The limit is halved on 429s, 5xx
+    responses or timeouts, and cut by a quarter when a latency is more than
+    `latency_tolerance` times its baseline. It starts at `initial` (by
+    default `min_limit`) and, while requests had to wait for a slot, doubles
+    every interval until the first decrease (slow start); from then on it is
+    raised by one when the throughput also went up since the last interval.
+    Each change is logged as a Singer METRIC line with its reason.
+    """
+
+    def __init__(
+        self, initial=None, min_limit=1, max_limit=10, interval=5.0, latency_tolerance=2.0, min_samples=5, logger=None
+    ):
+        self.limit = float(min_limit if initial is None else initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.latency_tolerance = latency_tolerance
+        self.min_samples = min_samples
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.saturated = False
+        self.stats = {}
+        self.baselines = {}
+        self.interval_start = time.monotonic()
+        self.last_throughput = None
+        self.slow_start = True
+        self.changes = []
+
+    @contextmanager
+    def slot(self, endpoint):
+        """Hold one of the `limit` slots for a request; set `outcome["status"]` to its status code."""
+        with self.condition:
+            while self.in_flight >= max(self.min_limit, int(self.limit)):
+                self.saturated = True
+                self.condition.wait()
+            self.in_flight += 1
+        outcome = {"status": None}
+        start = time.monotonic()
+        try:
+            yield outcome
+        finally:
+            latency = time.monotonic() - start
+            with self.condition:
+                self.in_flight -= 1
+                self.record(ENTITY_KEY.sub("", endpoint.split("?")[0]), latency, outcome["status"])
+                self.condition.notify_all()
+
+    def record(self, endpoint, latency, status):
+        stats = self.stats.setdefault(endpoint, EndpointStats())
+        stats.requests += 1
+        stats.latency += latency
+        if status == 429:
+            stats.throttled += 1
+        elif status is None or status >= 500:
+            stats.errors += 1
+
+        now = time.monotonic()
+        requests = sum(stats.requests for stats in self.stats.values())
+        if now - self.interval_start >= self.interval and requests >= self.min_samples:
+            self.adjust(requests / (now - self.interval_start))
+            self.stats = {}
+            self.saturated = False
+            self.interval_start = now
+
+    def adjust(self, throughput):
+        throttled = sum(stats.throttled for stats in self.stats.values())
+        errors = sum(stats.errors for stats in self.stats.values())
+        inflation, inflated_endpoint = 1.0, None
+        for endpoint, stats in self.stats.items():
+            mean = stats.latency / stats.requests
+            baseline = self.baselines.get(endpoint)
+            if baseline and mean / baseline > inflation:
+                inflation, inflated_endpoint = mean / baseline, endpoint
+            self.baselines[endpoint] = min(baseline or mean, mean)
+
+        limit, kind, reason = self.limit, None, None
+        if throttled:
+            limit, kind, reason = self.limit / 2, "throttled", f"{throttled} throttled responses"
+        elif errors:
+            limit, kind, reason = self.limit / 2, "errors", f"{errors} server errors or timeouts"
+        elif inflation > self.latency_tolerance:
+            limit, kind = self.limit * 0.75, "latency"
+            reason = f"latency of {inflated_endpoint} {inflation:.1f}x its baseline"
+        elif self.saturated and self.slow_start:
+            limit, kind, reason = self.limit * 2, "slow_start", f"slow start at {throughput:.1f} requests/s"
+        elif self.saturated and (self.last_throughput is None or throughput > self.last_throughput * 1.05):
+            limit, kind, reason = self.limit + 1, "throughput", f"throughput up to {throughput:.1f} requests/s"
+        self.last_throughput = throughput
+
+        if limit < self.limit:
+            self.slow_start = False
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if kind and limit != self.limit:
+            self.changes.append((self.limit, limit, kind))
+            self.log_metric(self.limit, limit, reason, throughput)
+            self.limit = limit
+
+    def log_metric(self, previous, limit, reason, throughput):
+        if not self.logger:
+            return
+        metric = {
+            "type": "gauge",
+            "metric": "concurrency_limit",
+            "value": round(limit, 2),
+            "tags": {"previous": round(previous, 2), "reason": reason, "throughput": round(throughput, 2)},
+        }
+        self.logger.info(f"METRIC: {json.dumps(metric)}")
+
+    def summary(self):
+        return {
+            "limit": round(self.limit, 2),
+            "max_limit_reached": round(max([self.limit, *(new for _, new, _ in self.changes)]), 2),
+            "increases": sum(1 for old, new, _ in self.changes if new > old),
+            "decreases": dict(Counter(kind for old, new, kind in self.changes if new < old)),
+        }
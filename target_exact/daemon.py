@@ -0,0 +1,228 @@
+"""Long-running target process serving Singer jobs over a socket or a spool directory.
+
+The process imports the target once and keeps what is expensive to rebuild
+warm across jobs: the HTTP connection pool, the OAuth token, the lookup
+indexes and the rate limit state. Every job gets a new `TargetExact` (fresh
+sinks and state) whose STATE output goes to that job only.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+
+from target_exact.lookups import SingleFlight
+from target_exact.rate_limits import RateLimitGate
+
+ERROR_TYPE = "DAEMON_ERROR"
+CHUNK_SIZE = 1 << 16
+
+logger = logging.getLogger("target-exact-daemon")
+
+
+class IndexCache(OrderedDict):
+    """Lookup indexes kept across jobs, least recently used first."""
+
+    def __init__(self):
+        super().__init__()
+        self.loaded_at = {}
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.loaded_at[key] = time.monotonic()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.loaded_at.pop(key, None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def evict(self, max_entities, max_age):
+        """Drop indexes older than `max_age` seconds, then the least recently used above `max_entities`."""
+        now = time.monotonic()
+        for key in [key for key, loaded_at in self.loaded_at.items() if now - loaded_at > max_age]:
+            del self[key]
+        total = sum(len(index) for index in self.values())
+        while total > max_entities and self:
+            key = next(iter(self))
+            total -= len(super().__getitem__(key))
+            del self[key]
+
+
+class TargetDaemon:
+    """Runs the jobs one at a time, on targets sharing the warm state in `warm`."""
+
+    def __init__(self, config_path, max_cached_entities=1_000_000, cache_ttl=3600, target_class=None):
+        if target_class is None:
+            from target_exact.target import TargetExact as target_class
+
+        self.target_class = target_class
+        self.config_path = config_path
+        self.max_cached_entities = max_cached_entities
+        self.cache_ttl = cache_ttl
+        # target attributes kept from one job to the next
+        self.warm = {
+            "lookup_indexes": IndexCache(),
+            "rate_limits": RateLimitGate(),
+            "in_flight": SingleFlight(),
+            "metadata": {},
+            "hedger": None,
+            "session": None,
+        }
+        # import the sinks now rather than in the first job
+        self.sink_types = self.target_class.SINK_TYPES
+
+    def run_job(self, file_input, output):
+        """Run one Singer input through a new target, writing its output to `output`."""
+        self.warm["lookup_indexes"].evict(self.max_cached_entities, self.cache_ttl)
+        start = time.monotonic()
+        # the config file is re-read per job, so a token refreshed by an earlier job is used
+        target = self.target_class(config=[self.config_path])
+        for name, value in self.warm.items():
+            setattr(target, name, value)
+        try:
+            with contextlib.redirect_stdout(output):
+                target.listen(file_input)
+                output.flush()
+        finally:
+            # e.g. the session and hedger are created during the first job
+            for name in self.warm:
+                self.warm[name] = getattr(target, name)
+        logger.info(f"Job done in {time.monotonic() - start:.2f}s")
+
+    def serve_socket(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the jobs run with the daemon's credentials, only its user may connect
+        umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        logger.info(f"Listening on {path}")
+        try:
+            while True:
+                connection, _ = server.accept()
+                with connection:
+                    self.handle_connection(connection)
+        finally:
+            server.close()
+            os.unlink(path)
+
+    def handle_connection(self, connection):
+        # the whole input is spooled first, the client half-closes when it is sent
+        with tempfile.TemporaryFile("w+b") as spool:
+            while chunk := connection.recv(CHUNK_SIZE):
+                spool.write(chunk)
+            spool.seek(0)
+            output = connection.makefile("w", encoding="utf-8")
+            try:
+                self.run_job(open(spool.fileno(), encoding="utf-8", closefd=False), output)
+            except Exception as e:
+                logger.exception("Job failed")
+                output.write(json.dumps({"type": ERROR_TYPE, "error": repr(e)}) + "\n")
+            finally:
+                with contextlib.suppress(OSError):
+                    output.close()
+
+    def serve_spool(self, directory, poll_interval=1.0):
+        """Run each `*.singer` file dropped in `directory`, writing `<name>.state` next to it."""
+        logger.info(f"Watching {directory}")
+        while True:
+            paths = sorted(glob.glob(os.path.join(directory, "*.singer")), key=os.path.getmtime)
+            if not paths:
+                time.sleep(poll_interval)
+                continue
+            for path in paths:
+                self.run_spooled(path)
+
+    def run_spooled(self, path):
+        base = path[: -len(".singer")]
+        processing = f"{base}.processing"
+        try:
+            # claim the file, another daemon on the directory may be faster
+            os.rename(path, processing)
+        except FileNotFoundError:
+            return
+        try:
+            with open(processing, encoding="utf-8") as file_input, open(f"{base}.state.tmp", "w") as output:
+                self.run_job(file_input, output)
+            os.replace(f"{base}.state.tmp", f"{base}.state")
+            os.unlink(processing)
+        except Exception:
+            logger.exception(f"Job {path} failed")
+            shutil.move(processing, f"{base}.failed")
+            with open(f"{base}.error", "w") as f:
+                f.write(traceback.format_exc())
+
+
+def submit(path, file_input=None, output=None):
+    """Send a Singer input to a daemon and copy its output; returns the exit code."""
+    file_input = file_input or sys.stdin.buffer
+    output = output or sys.stdout
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    with client:
+        while chunk := file_input.read(CHUNK_SIZE):
+            client.sendall(chunk)
+        client.shutdown(socket.SHUT_WR)
+        for line in client.makefile("r", encoding="utf-8"):
+            # the target's state lines are bare JSON, only the daemon's error has a type
+            if line.startswith("{") and f'"{ERROR_TYPE}"' in line:
+                message = json.loads(line)
+                if message.get("type") == ERROR_TYPE:
+                    sys.stderr.write(message["error"] + "\n")
+                    return 1
+            output.write(line)
+    output.flush()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep target-exact running between jobs.")
+    parser.add_argument("--config", help="Target config file (serving only)")
+    parser.add_argument("--socket", help="Unix socket to serve on, or to submit to")
+    parser.add_argument("--spool-dir", help="Directory to pick up *.singer inputs from")
+    parser.add_argument("--submit", action="store_true", help="Send stdin to the daemon on --socket")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--max-cached-entities", type=int, default=1_000_000)
+    parser.add_argument("--cache-ttl", type=float, default=3600, help="Seconds lookup indexes are reused")
+    args = parser.parse_args(argv)
+
+    if args.submit:
+        if not args.socket:
+            parser.error("--submit needs --socket")
+        return submit(args.socket)
+    if not args.config or not (args.socket or args.spool_dir):
+        parser.error("serving needs --config and --socket or --spool-dir")
+
+    logging.basicConfig(level=logging.INFO)
+    daemon = TargetDaemon(args.config, args.max_cached_entities, args.cache_ttl)
+    try:
+        if args.socket:
+            daemon.serve_socket(args.socket)
+        else:
+            daemon.serve_spool(args.spool_dir, args.poll_interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""Dead letter queue for records whose write failed with a transient error."""
+import json
+import os
+
+
+class DeadLetterQueue:
+    """Failed records and their prepared payloads, spooled to a JSONL file.
+
+    The file only holds the current run's failures: it is truncated when the
+    queue is created and rewritten with the records that still fail after the
+    retry pass.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        open(self.path, "w").close()
+
+    def add(self, record: dict, error: str):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"record": record, "error": error}, default=str) + "\n")
+        self.count += 1
+
+    def drain(self):
+        """Return the dead letters and empty the queue."""
+        with open(self.path) as f:
+            letters = [json.loads(line) for line in f if line.strip()]
+        open(self.path, "w").close()
+        self.count = 0
+        return letters
+
+    def __len__(self):
+        return self.count
@@ -7,4 +7,27 @@ class MissingItemError(Exception):
 
 
 class InvalidOrderedByError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidReferenceError(Exception):
+    pass
+
+
+class PartialDocumentError(Exception):
+    pass
+
+
+class PayloadValidationError(Exception):
+    pass
+
+
+class MissingEntityKeyError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        # seconds until the endpoint gets a trial request
+        self.retry_after = retry_after
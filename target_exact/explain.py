@@ -0,0 +1,101 @@
+"""Dry-run mode estimating the Exact API calls an input would cost."""
+import contextvars
+import heapq
+import json
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+DRY_RUN_ID = "00000000-0000-0000-0000-000000000000"
+KEY_PROPERTIES = ["ID", "OrderID", "EntryID", "TransferID", "PurchaseOrderID", "StockCountID"]
+
+current_record = contextvars.ContextVar("current_record", default=None)
+
+
+class DryRunResponse:
+    """Stands in for the API response of a request the dry run does not send."""
+
+    def __init__(self, http_method):
+        properties = "".join(
+            f'<d:{key} m:type="Edm.Guid">{DRY_RUN_ID}</d:{key}>' for key in KEY_PROPERTIES
+        )
+        entry = f"<entry><content><m:properties>{properties}</m:properties></content></entry>"
+        self.status_code = 200 if http_method == "GET" else 201
+        self.text = f"<feed>{entry}</feed>" if http_method == "GET" else entry
+        self.headers = {"Location": f"(guid'{DRY_RUN_ID}')"}
+
+
+class ExplainPlan:
+    """Counts, per record and per stream, the requests the input would need.
+
+    `lookups_cold` is every reference lookup the sinks make, `lookups` the ones
+    that would still reach the API with the caches of this run. The runtime is
+    projected from the warm total and Exact's minutely and daily limits, as
+    fractions of a minute and of a day.
+    """
+
+    def __init__(self, minutely_limit=60, daily_limit=5000, worst_records=10):
+        self.minutely_limit = minutely_limit
+        self.daily_limit = daily_limit
+        self.worst_records = worst_records
+        self.streams = {}
+        self.worst = []
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def count(self, kind, stream=None, n=1):
+        counts = current_record.get()
+        if counts is None:
+            # outside of a record, e.g. bulk index loads or batched writes
+            with self.lock:
+                self.streams.setdefault(stream or "(run)", Counter())[kind] += n
+            return
+        counts[kind] += n
+
+    @contextmanager
+    def record(self, stream, key):
+        counts = Counter()
+        token = current_record.set(counts)
+        try:
+            yield counts
+        finally:
+            current_record.reset(token)
+            calls = counts["lookups"] + counts["writes"]
+            with self.lock:
+                totals = self.streams.setdefault(stream, Counter())
+                totals.update(counts)
+                totals["records"] += 1
+                self.records += 1
+                entry = (calls, self.records, stream, str(key), dict(counts))
+                if len(self.worst) < self.worst_records:
+                    heapq.heappush(self.worst, entry)
+                else:
+                    heapq.heappushpop(self.worst, entry)
+
+    def report(self):
+        totals = Counter()
+        for counts in self.streams.values():
+            totals.update(counts)
+        cold = totals["lookups_cold"] + totals["writes"] + totals["bulk_loads"]
+        warm = totals["lookups"] + totals["writes"] + totals["bulk_loads"]
+        return {
+            "streams": {stream: dict(counts) for stream, counts in self.streams.items()},
+            "totals": dict(totals),
+            "calls": {"cold": cold, "warm": warm},
+            "projected_runtime": {
+                "minutes_at_minutely_limit": round(warm / self.minutely_limit, 4),
+                "days_at_daily_limit": round(warm / self.daily_limit, 4),
+            },
+            "worst_records": [
+                {"stream": stream, "key": key, "calls": calls, **counts}
+                for calls, _, stream, key, counts in sorted(self.worst, reverse=True)
+            ],
+        }
+
+    def write_report(self, logger, path=None):
+        report = self.report()
+        logger.info(f"Dry run estimate: {json.dumps(report)}")
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=4)
+        return report
@@ -0,0 +1,69 @@
+"""Hedged requests for idempotent lookups."""
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class HedgedRequests:
+    """Sends a second copy of a request that is slower than usual.
+
+    Once `min_samples` latencies are known, a request still running after the
+    `percentile` latency gets a duplicate and the first response to arrive is
+    used. At most `max_hedge_rate` of the requests are hedged, which bounds
+    the extra API calls. Only use it for idempotent requests (GETs).
+    """
+
+    def __init__(self, max_hedge_rate=0.05, percentile=0.95, min_samples=20, max_workers=8):
+        self.max_hedge_rate = max_hedge_rate
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=1000)
+        self.requests = 0
+        self.hedges = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="exact-hedge")
+
+    def hedge_delay(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * self.percentile), len(latencies) - 1)]
+
+    def timed(self, send):
+        start = time.monotonic()
+        response = send()
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return response
+
+    def can_hedge(self):
+        with self.lock:
+            return self.hedges < self.requests * self.max_hedge_rate
+
+    def send(self, send):
+        """Call `send()`, hedging it if it is slow. Returns the first successful response."""
+        with self.lock:
+            self.requests += 1
+        delay = self.hedge_delay()
+        if delay is None:
+            return self.timed(send)
+
+        first = self.executor.submit(contextvars.copy_context().run, self.timed, send)
+        done, _ = wait([first], timeout=delay)
+        if done or not self.can_hedge():
+            return first.result()
+
+        with self.lock:
+            self.hedges += 1
+        pending = {first, self.executor.submit(contextvars.copy_context().run, self.timed, send)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
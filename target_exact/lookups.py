@@ -0,0 +1,356 @@
+"""Compact reference indexes for Exact entity sets."""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+
+
+# fields entities are looked up by; these are always indexed when known
+LOOKUP_FIELDS = ("Code", "Name", "Description", "CodeAtSupplier")
+
+GUID_SIZE = 16
+MAX_KEY_LENGTH = 0xFFFF
+SNAPSHOT_MAGIC = b"EXACTIDX"
+SNAPSHOT_HEADER = struct.Struct("<8sI")
+
+
+def normalize_key(value):
+    # Exact compares filter values case-insensitively, so the index does too
+    if value is None:
+        return None
+    return str(value).strip().lower()
+
+
+def guid_bytes(value):
+    """The 16-byte form of a GUID string, or None if it is not a GUID."""
+    try:
+        return uuid.UUID(str(value)).bytes
+    except ValueError:
+        return None
+
+
+def key_digest(key):
+    # stable across processes, unlike hash(), so tables can be shared through a snapshot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=4).digest(), "little")
+
+
+class KeyTable:
+    """Open-addressing hash table from byte keys to row numbers, in flat buffers.
+
+    Each slot is (key digest, key offset, row + 1, key length), the keys live
+    in `keys` (which may be shared with other tables). The buffers are
+    bytearrays, or read-only views of a memory-mapped snapshot.
+
+    Lookups may run while another thread adds a key: a slot is only filled
+    once its key is stored, and a grown table replaces `slots` in one
+    assignment, so a lookup sees either buffer whole. Adds must not run
+    concurrently; `EntityIndex` serializes them.
+    """
+
+    SLOT = struct.Struct("<IIIH")
+
+    __slots__ = ("slots", "keys", "size")
+
+    def __init__(self, keys, slots=None, size=0):
+        self.keys = keys
+        self.slots = slots if slots is not None else bytearray(8 * self.SLOT.size)
+        self.size = size
+
+    @property
+    def capacity(self):
+        return len(self.slots) // self.SLOT.size
+
+    def find(self, key, digest, slots=None):
+        slots = self.slots if slots is None else slots
+        mask = len(slots) // self.SLOT.size - 1
+        slot = digest & mask
+        while True:
+            slot_digest, offset, row, length = self.SLOT.unpack_from(slots, slot * self.SLOT.size)
+            if not row or (slot_digest == digest and self.keys[offset:offset + length] == key):
+                return slot, row - 1
+            slot = (slot + 1) & mask
+
+    def get(self, key):
+        _, row = self.find(key, key_digest(key))
+        return row if row >= 0 else None
+
+    def add(self, key, offset, row):
+        """Map `key`, stored at `offset` in `keys`, to `row` unless it is mapped already."""
+        digest = key_digest(key)
+        slots = self.slots
+        if (self.size + 1) * 3 > len(slots) // self.SLOT.size * 2:
+            slots = self.grown()
+        slot, existing = self.find(key, digest, slots)
+        if existing >= 0:
+            return False
+        self.SLOT.pack_into(slots, slot * self.SLOT.size, digest, offset, row + 1, len(key))
+        self.size += 1
+        self.slots = slots
+        return True
+
+    def grown(self):
+        """A copy of the slots at twice the capacity, rehashed."""
+        capacity = self.capacity * 2
+        slots = bytearray(capacity * self.SLOT.size)
+        for position in range(0, len(self.slots), self.SLOT.size):
+            digest, offset, row, length = self.SLOT.unpack_from(self.slots, position)
+            if row:
+                slot = digest & (capacity - 1)
+                while self.SLOT.unpack_from(slots, slot * self.SLOT.size)[2]:
+                    slot = (slot + 1) & (capacity - 1)
+                self.SLOT.pack_into(slots, slot * self.SLOT.size, digest, offset, row, length)
+        return slots
+
+
+class EntityValues:
+    """Current values of one indexed entity, stored as a tuple in the index."""
+
+    __slots__ = ("index", "row")
+
+    def __init__(self, index, row):
+        self.index = index
+        self.row = row
+
+    def get(self, field):
+        values = self.index.values.get(self.row)
+        position = self.index.value_positions.get(field)
+        if values is None or position is None:
+            return None
+        return values[position]
+
+    def update(self, changes):
+        if self.row is None:
+            return
+        with self.index.lock:
+            values = list(self.index.values.get(self.row) or [None] * len(self.index.value_fields))
+            for field, value in changes.items():
+                if field in self.index.value_positions:
+                    values[self.index.value_positions[field]] = value
+            self.index.values[self.row] = tuple(values)
+
+
+class EntityIndex:
+    """Bulk-loaded index of one Exact entity set.
+
+    Entities are indexed by ID and by each of the given lookup fields
+    (e.g. Code, Name, Description), so references can be resolved without
+    issuing one GET per record. The current value of each of `value_fields`
+    is kept per entity, to compare incoming payloads against.
+
+    An index that is not `complete` only caches the entities seen so far
+    (lookup results and entities created during the run), so a miss there
+    still has to be asked to the API.
+
+    No Python object is kept per entity: IDs are stored as 16-byte GUIDs in
+    one bytearray, normalized keys in another (once per entity when several
+    fields share a value) and the lookup tables are `KeyTable`s mapping them
+    to row numbers. An index can be saved to a snapshot file and reopened
+    memory-mapped, so several processes share one copy; entities added after
+    that are kept in memory on top of the snapshot.
+
+    Adds are serialized by a lock; lookups take no lock, since the tables
+    only publish an entity once it is fully stored.
+    """
+
+    __slots__ = (
+        "fields", "value_fields", "value_positions", "complete", "snapshot",
+        "guids", "keys", "ids", "tables", "values", "lock",
+    )
+
+    def __init__(self, fields=(), value_fields=(), complete=False, snapshot=None):
+        self.fields = list(fields)
+        self.value_fields = list(value_fields)
+        self.value_positions = {field: position for position, field in enumerate(self.value_fields)}
+        self.complete = complete
+        self.snapshot = snapshot
+        self.guids = bytearray()
+        self.keys = bytearray()
+        # the ID table's keys are the GUIDs themselves
+        self.ids = KeyTable(self.guids)
+        self.tables = {field: KeyTable(self.keys) for field in (*self.fields, *LOOKUP_FIELDS)}
+        # row -> tuple of the value_fields
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, entity: dict):
+        guid = guid_bytes(entity.get("ID"))
+        if guid is None:
+            return
+        with self.lock:
+            row = self.ids.get(guid)
+            if row is None:
+                row = self.ids.size
+                self.guids += guid
+                self.ids.add(guid, row * GUID_SIZE, row)
+            if self.value_fields:
+                self.values[row] = tuple(entity.get(field) for field in self.value_fields)
+            offsets = {}
+            for field, table in self.tables.items():
+                value = normalize_key(entity.get(field))
+                if not value:
+                    continue
+                key = value.encode()
+                # keep the first match, like `get_id` does with multiple entries
+                if len(key) > MAX_KEY_LENGTH or table.get(key) is not None:
+                    continue
+                if key not in offsets:
+                    # stored before the slot pointing at it is filled
+                    offsets[key] = len(self.keys)
+                    self.keys += key
+                table.add(key, offsets[key], row)
+
+    def guid(self, row):
+        return str(uuid.UUID(bytes=bytes(self.guids[row * GUID_SIZE:(row + 1) * GUID_SIZE])))
+
+    def get(self, field, value):
+        if field == "ID":
+            return value if value in self else None
+        key = normalize_key(value)
+        table = self.tables.get(field)
+        if not key or table is None:
+            return None
+        row = table.get(key.encode())
+        if row is not None:
+            return self.guid(row)
+        if self.snapshot is not None:
+            return self.snapshot.get(field, value)
+        return None
+
+    def is_complete(self, field):
+        """Whether a miss on `field` means the entity does not exist."""
+        return self.complete and (field == "ID" or field in self.fields)
+
+    def get_values(self, id):
+        return EntityValues(self, self.ids.get(guid_bytes(id) or b""))
+
+    def save_snapshot(self, path):
+        """Write the index to `path`, to be reopened with `open_snapshot`."""
+        if self.snapshot is not None or self.values:
+            raise ValueError("Only lookup indexes loaded into memory can be saved")
+        sections = {"guids": self.guids, "keys": self.keys, "ID": self.ids.slots}
+        sections.update({field: table.slots for field, table in self.tables.items()})
+        offsets, position = {}, 0
+        for name, data in sections.items():
+            offsets[name] = [position, len(data)]
+            position += len(data)
+        header = json.dumps({
+            "fields": self.fields,
+            "complete": self.complete,
+            "sizes": {"ID": self.ids.size, **{field: table.size for field, table in self.tables.items()}},
+            "sections": offsets,
+        }).encode()
+
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(header)))
+            f.write(header)
+            for data in sections.values():
+                f.write(data)
+        # readers only ever see complete snapshots
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def open_snapshot(cls, path, fields=(), max_age=None):
+        """Open the index saved at `path`, if it has `fields` and is not older than `max_age` seconds."""
+        try:
+            if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+                return None
+            with open(path, "rb") as f:
+                data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            return None
+        magic, header_size = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        start = SNAPSHOT_HEADER.size + header_size
+        header = json.loads(bytes(data[SNAPSHOT_HEADER.size:start]))
+        if not set(fields) <= set(header["fields"]):
+            return None
+
+        def section(name):
+            offset, length = header["sections"][name]
+            return data[start + offset:start + offset + length]
+
+        snapshot = cls(header["fields"], complete=header["complete"])
+        snapshot.guids, snapshot.keys = section("guids"), section("keys")
+        snapshot.ids = KeyTable(snapshot.guids, section("ID"), header["sizes"]["ID"])
+        snapshot.tables = {
+            field: KeyTable(snapshot.keys, section(field), size) for field, size in header["sizes"].items()
+            if field != "ID"
+        }
+        # the mapped tables are read-only, entities added later go to memory
+        return cls(header["fields"], complete=header["complete"], snapshot=snapshot)
+
+    def __contains__(self, id):
+        guid = guid_bytes(id)
+        if guid is None:
+            return False
+        return self.ids.get(guid) is not None or (self.snapshot is not None and id in self.snapshot)
+
+    def __len__(self):
+        if self.snapshot is None:
+            return self.ids.size
+        added = sum(1 for row in range(self.ids.size) if self.guid(row) not in self.snapshot)
+        return len(self.snapshot) + added
+
+
+def same_value(current, new):
+    """Compare a value read from the Atom feed (always text) with a payload value."""
+    if current in (None, "") or new in (None, ""):
+        return current in (None, "") and new in (None, "")
+    if isinstance(new, bool):
+        return str(current).lower() == str(new).lower()
+    if isinstance(new, (int, float)):
+        try:
+            return float(current) == float(new)
+        except ValueError:
+            return False
+    return str(current) == str(new)
+
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls.
+
+    The first caller for a key runs the call; callers arriving while it is in
+    flight wait for it and get the same result (or exception), so duplicate
+    requests are bounded by the distinct keys, not by the number of threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
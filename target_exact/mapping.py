@@ -0,0 +1,71 @@
+"""Value formatting and line item decoding shared by the sinks' mappings."""
+import json
+import re
+from datetime import datetime
+from functools import lru_cache
+
+EXACT_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+DATETIME_FORMATS = ("date-time", "date")
+
+json_decoder = json.JSONDecoder()
+whitespace = re.compile(r"[ \t\n\r]*")
+# line item strings from this size on are decoded one item at a time
+INCREMENTAL_DECODE_SIZE = 1 << 20
+
+
+@lru_cache(maxsize=8192)
+def format_datetime_string(value):
+    # batch exports repeat the same few timestamps, so parsed strings are memoized
+    try:
+        parsed = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        from pendulum import parse
+
+        parsed = parse(value)
+    return parsed.strftime(EXACT_DATETIME_FORMAT)
+
+
+def format_datetime(value):
+    """Format a datetime (or a date-time string) the way Exact expects it."""
+    if value is None or isinstance(value, datetime):
+        return value.strftime(EXACT_DATETIME_FORMAT) if value else None
+    return format_datetime_string(value)
+
+
+def is_datetime_property(schema):
+    if schema.get("format") in DATETIME_FORMATS:
+        return True
+    return any(is_datetime_property(option) for option in schema.get("anyOf", []))
+
+
+def iter_json_array(text):
+    """Decode the items of a JSON array string one at a time.
+
+    Line items arrive as one (possibly huge) JSON string; decoding them item by
+    item means only the mapped lines are kept, not a full copy of the input.
+    """
+    index = whitespace.match(text, 0).end()
+    if text[index:index + 1] != "[":
+        raise ValueError(f"Expecting a JSON array at char {index}")
+    index = whitespace.match(text, index + 1).end()
+    if text[index:index + 1] == "]":
+        return
+    while True:
+        item, index = json_decoder.raw_decode(text, index)
+        yield item
+        index = whitespace.match(text, index).end()
+        delimiter = text[index:index + 1]
+        if delimiter == "]":
+            return
+        if delimiter != ",":
+            raise ValueError(f"Expecting ',' delimiter at char {index}")
+        index = whitespace.match(text, index + 1).end()
+
+
+def decode_lines(value):
+    if isinstance(value, str):
+        # smaller arrays decode faster in one go
+        if len(value) < INCREMENTAL_DECODE_SIZE:
+            return json.loads(value)
+        return iter_json_array(value)
+    return value or []
@@ -0,0 +1,19 @@
+"""Decoding of Singer messages, with orjson when it is installed."""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(line):
+    """Decode one Singer message line."""
+    if orjson is None:
+        return json.loads(line)
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        # orjson rejects what the standard library accepts, e.g. NaN (it
+        # decodes integers above 64 bits as floats, though)
+        return json.loads(line)
@@ -0,0 +1,202 @@
+"""Payload validators compiled from the OData $metadata of Exact's services.
+
+`parse_metadata` reads the entity types of one service's $metadata document
+and `compile_validators` turns each entity set into a validator, a function
+running one check tuple per property, which returns the problems of a
+payload without sending it.
+"""
+import re
+from datetime import datetime
+
+GUID = re.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
+
+# properties Exact rejects a write without, by entity set; $metadata only
+# says which properties cannot be null, not which ones a POST needs
+REQUIRED_PROPERTIES = {
+    "PurchaseOrders": ["Supplier", "PurchaseOrderLines"],
+    "PurchaseOrderLines": ["Item"],
+    "SalesOrders": ["OrderedBy", "SalesOrderLines"],
+    "SalesOrderLines": ["Item"],
+    "WarehouseTransfers": ["WarehouseFrom", "WarehouseTo", "WarehouseTransferLines"],
+    "WarehouseTransferLines": ["Item"],
+    "StockCounts": ["Warehouse", "StockCountLines"],
+    "StockCountLines": ["Item"],
+}
+
+
+def is_integer(value):
+    if value.__class__ is int:
+        return True
+    if isinstance(value, float):
+        return value.is_integer()
+    if isinstance(value, str):
+        return value.strip().lstrip("+-").isdigit()
+    return False
+
+
+def is_number(value):
+    if isinstance(value, (int, float)):
+        return value.__class__ is not bool
+    if isinstance(value, str):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+def is_string(value):
+    # Exact converts numbers to text, e.g. an order number sent as YourRef
+    return isinstance(value, (str, int, float)) and value.__class__ is not bool
+
+
+def is_guid(value):
+    return isinstance(value, str) and GUID.match(value) is not None
+
+
+def is_boolean(value):
+    return value.__class__ is bool
+
+
+def is_datetime(value):
+    return isinstance(value, (str, datetime))
+
+
+EDM_CHECKS = {
+    "Edm.String": is_string,
+    "Edm.Guid": is_guid,
+    "Edm.Boolean": is_boolean,
+    "Edm.Byte": is_integer,
+    "Edm.Int16": is_integer,
+    "Edm.Int32": is_integer,
+    "Edm.Int64": is_integer,
+    "Edm.Double": is_number,
+    "Edm.Single": is_number,
+    "Edm.Decimal": is_number,
+    "Edm.DateTime": is_datetime,
+    "Edm.DateTimeOffset": is_datetime,
+    "Edm.Binary": is_string,
+}
+
+
+class Property:
+    def __init__(self, name, type, nullable=True, max_length=None, key=False):
+        self.name = name
+        self.type = type
+        self.nullable = nullable
+        self.max_length = max_length
+        self.key = key
+
+
+def parse_metadata(text):
+    """Return the properties and navigation properties of each entity set in a $metadata document."""
+    import xmltodict
+
+    document = xmltodict.parse(
+        text, force_list=("Schema", "EntityType", "Property", "NavigationProperty", "EntityContainer", "EntitySet")
+    )
+    root = document.get("edmx:Edmx") or {}
+    schemas = (root.get("edmx:DataServices") or {}).get("Schema") or []
+
+    types = {}
+    entity_sets = {}
+    for schema in schemas:
+        namespace = schema.get("@Namespace")
+        for entity_type in schema.get("EntityType") or []:
+            properties = []
+            key = (entity_type.get("Key") or {}).get("PropertyRef") or []
+            key_names = {ref["@Name"] for ref in (key if isinstance(key, list) else [key])}
+            for property in entity_type.get("Property") or []:
+                max_length = property.get("@MaxLength")
+                properties.append(Property(
+                    property["@Name"],
+                    property.get("@Type"),
+                    nullable=property.get("@Nullable", "true").lower() != "false",
+                    max_length=int(max_length) if max_length and max_length.isdigit() else None,
+                    key=property["@Name"] in key_names,
+                ))
+            navigation = [nav["@Name"] for nav in entity_type.get("NavigationProperty") or []]
+            types[f"{namespace}.{entity_type['@Name']}"] = (properties, navigation)
+        for container in schema.get("EntityContainer") or []:
+            for entity_set in container.get("EntitySet") or []:
+                entity_sets[entity_set["@Name"]] = entity_set["@EntityType"]
+
+    return {name: types[type] for name, type in entity_sets.items() if type in types}
+
+
+def compile_validator(entity_set, properties, required=(), max_lengths=None, lines=None, skip=()):
+    """Build a `validate(payload, truncate) -> [errors]` function for one entity set.
+
+    `lines` maps navigation properties (e.g. SalesOrderLines) to the
+    validators of their entity sets, and `skip` names properties not to
+    check. With `truncate`, strings over the max length are cut to it instead
+    of being reported.
+    """
+    max_lengths = max_lengths or {}
+    names = {property.name for property in properties}
+    # (name, required, nullable, type check, type, max length), properties without checks left out
+    checks = []
+    for property in properties:
+        if property.name in skip:
+            continue
+        check = EDM_CHECKS.get(property.type)
+        max_length = max_lengths.get(property.name, property.max_length) if property.type == "Edm.String" else None
+        if property.nullable and property.name not in required and not check and not max_length:
+            continue
+        checks.append((property.name, property.name in required, property.nullable, check, property.type, max_length))
+    # required properties that are navigation properties (document lines)
+    required_lines = [name for name in required if name not in names]
+    lines = list((lines or {}).items())
+
+    def validate(payload, truncate):
+        errors = []
+        for name, is_required, nullable, check, type, max_length in checks:
+            value = payload.get(name)
+            if value is None:
+                if is_required:
+                    errors.append(f"{name} is required")
+                elif not nullable and name in payload:
+                    errors.append(f"{name} cannot be null")
+            elif check and not check(value):
+                errors.append(f"{name}: expected {type}, got {value!r}")
+            elif max_length and len(str(value)) > max_length:
+                if truncate:
+                    payload[name] = str(value)[:max_length]
+                else:
+                    errors.append(f"{name} is longer than {max_length} characters")
+        for name in required_lines:
+            if payload.get(name) is None:
+                errors.append(f"{name} is required")
+        for name, validate_line in lines:
+            for index, line in enumerate(payload.get(name) or []):
+                errors.extend(f"{name}[{index}].{error}" for error in validate_line(line, truncate))
+        return errors
+
+    return validate
+
+
+def compile_validators(entity_sets, required=None, max_lengths=None):
+    """Compile the validators of all entity sets of one service, by entity set name.
+
+    Lines nested in a document are not checked for the document's key (e.g.
+    SalesOrderLines.OrderID), which Exact fills in from their document.
+    """
+    required = {**REQUIRED_PROPERTIES, **(required or {})}
+    max_lengths = max_lengths or {}
+    validators = {}
+
+    def compile_entity_set(name, parents, skip=frozenset()):
+        if (name, skip) not in validators:
+            properties, navigation = entity_sets[name]
+            keys = frozenset(property.name for property in properties if property.key)
+            lines = {
+                nav: compile_entity_set(nav, {*parents, name}, keys)
+                for nav in navigation if nav in entity_sets and nav not in parents and nav != name
+            }
+            validators[name, skip] = compile_validator(
+                name, properties, required.get(name, ()), max_lengths.get(name), lines, skip
+            )
+        return validators[name, skip]
+
+    return {name: compile_entity_set(name, set()) for name in entity_sets}
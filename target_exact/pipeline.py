@@ -0,0 +1,56 @@
+"""Background write stage for sinks."""
+import contextvars
+import queue
+import threading
+
+STOP = object()
+
+
+class RecordPipeline:
+    """Runs the write stage of a sink (POST and state update) on a worker thread.
+
+    While the worker writes a record, the SDK thread decodes the next records
+    and resolves their references. The bounded queue caps how many prepared
+    records are held in memory and the single worker keeps the output order.
+    """
+
+    def __init__(self, handler, depth):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is STOP:
+                    return
+                if self.error is None:
+                    context, args = item
+                    context.run(self.handler, *args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, *args):
+        self._raise_error()
+        # run the write in the caller's context, e.g. to keep its trace
+        self.queue.put((contextvars.copy_context(), args))
+
+    def join(self):
+        """Wait until every queued record is written."""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.queue.put(STOP)
+        self.thread.join()
+        self._raise_error()
@@ -0,0 +1,36 @@
+"""Client-side handling of Exact's API rate limits."""
+import threading
+import time
+
+
+class RateLimitGate:
+    """Holds requests back once the minutely rate limit is used up.
+
+    Exact reports the calls left for the whole tenant in the
+    X-RateLimit-Minutely-* headers of every response, so processes writing to
+    the same tenant share the budget by following them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset_at = 0.0
+        self.minutely_remaining = None
+        self.daily_remaining = None
+
+    def update(self, headers):
+        remaining = headers.get("X-RateLimit-Minutely-Remaining")
+        reset = headers.get("X-RateLimit-Minutely-Reset")
+        with self.lock:
+            if headers.get("X-RateLimit-Remaining") is not None:
+                self.daily_remaining = int(headers["X-RateLimit-Remaining"])
+            if remaining is None:
+                return
+            self.minutely_remaining = int(remaining)
+            if self.minutely_remaining <= 0 and reset:
+                # reset is a unix timestamp in milliseconds
+                self.reset_at = max(self.reset_at, int(reset) / 1000)
+
+    def wait(self):
+        delay = self.reset_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
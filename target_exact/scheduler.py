@@ -0,0 +1,115 @@
+"""Dependency-aware scheduling of the streams of one input."""
+import contextlib
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+# streams whose records reference entities written by other streams: Suppliers
+# creates the Accounts and products the Items the others look up
+STREAM_DEPENDENCIES = {
+    "BuyOrders": ["Suppliers", "products"],
+    "PurchaseInvoices": ["Suppliers", "products"],
+    "PurchaseEntries": ["Suppliers"],
+    "SalesOrders": ["products"],
+    "ShopOrders": ["products"],
+    "WarehouseTransfers": ["products"],
+    "UpdateInventory": ["products"],
+}
+
+
+def dependency_graph(dependencies, overrides=None):
+    """Merge `overrides` (e.g. from the config) into `dependencies`, with lowercased stream names."""
+    graph = {}
+    for stream, prerequisites in {**dependencies, **(overrides or {})}.items():
+        graph[stream.lower()] = [prerequisite.lower() for prerequisite in prerequisites]
+    return graph
+
+
+class StreamScheduler:
+    """Runs one task per stream once the tasks of its prerequisites are done.
+
+    Streams that do not depend on each other run concurrently, each on its
+    own thread, so the wall-clock time is the longest chain of dependent
+    streams rather than the sum of all of them. Prerequisites that have no
+    task (because they were processed already or are not in the input)
+    count as done.
+    """
+
+    def __init__(self, graph, max_workers):
+        self.graph = graph
+        self.max_workers = max_workers
+
+    def prerequisites(self, stream, streams):
+        return [name for name in streams if name.lower() in self.graph.get(stream.lower(), [])]
+
+    def check_cycles(self, streams):
+        visiting, done = set(), set()
+
+        def visit(stream, path):
+            if stream in done:
+                return
+            if stream in visiting:
+                raise ValueError(f"Stream dependencies form a cycle: {' -> '.join([*path, stream])}")
+            visiting.add(stream)
+            for prerequisite in self.prerequisites(stream, streams):
+                visit(prerequisite, [*path, stream])
+            visiting.discard(stream)
+            done.add(stream)
+
+        for stream in streams:
+            visit(stream, [])
+
+    def run(self, tasks):
+        """Run `tasks` (stream name -> callable) in dependency order."""
+        self.check_cycles(tasks)
+        waiting = {stream: set(self.prerequisites(stream, tasks)) for stream in tasks}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stream") as executor:
+            while waiting or running:
+                for stream in [stream for stream, prerequisites in waiting.items() if not prerequisites]:
+                    del waiting[stream]
+                    running[executor.submit(tasks[stream])] = stream
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stream = running.pop(future)
+                    # raises the error of the failed stream; streams not started yet never run
+                    future.result()
+                    for prerequisites in waiting.values():
+                        prerequisites.discard(stream)
+
+
+class SharedStateLock:
+    """Serializes the SDK's bookkeeping (sinks, counters, state) across threads.
+
+    A thread holds the lock while it processes a record, and lets go of it
+    while it waits on the API or on another thread, so the requests of
+    concurrently replayed streams still overlap.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def held(self):
+        with self.lock:
+            self.local.depth = getattr(self.local, "depth", 0) + 1
+            try:
+                yield
+            finally:
+                self.local.depth -= 1
+
+    @contextlib.contextmanager
+    def released(self):
+        """Let go of the lock (if this thread holds it) for the duration of the block."""
+        depth = getattr(self.local, "depth", 0)
+        for _ in range(depth):
+            self.lock.release()
+        self.local.depth = 0
+        try:
+            yield
+        finally:
+            for _ in range(depth):
+                self.lock.acquire()
+            self.local.depth = depth
@@ -0,0 +1,184 @@
+"""Sharded execution: one coordinator process fanning records out to worker processes."""
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zlib
+
+from target_exact.messages import loads
+
+# set in the environment of the worker processes
+SHARD_ENV = "TARGET_EXACT_SHARD"
+
+
+def is_shard_worker():
+    return SHARD_ENV in os.environ
+
+
+def shard_key(record, key_properties, shard_key_field=None):
+    """Records with the same key (e.g. the same division or order) go to the same worker."""
+    if shard_key_field and record.get(shard_key_field) is not None:
+        return record[shard_key_field]
+    keys = [record.get(key) for key in key_properties or [] if record.get(key) is not None]
+    if keys:
+        return keys
+    for field in ["division", "order_id", "id"]:
+        if record.get(field) is not None:
+            return record[field]
+    return None
+
+
+def add_counts(current, new):
+    if isinstance(current, dict) and isinstance(new, dict):
+        return {key: add_counts(current.get(key), new.get(key)) for key in {*current, *new}}
+    if isinstance(current, (int, float)) and isinstance(new, (int, float)):
+        return current + new
+    return new if current is None else current
+
+
+def merge_states(results, incoming=None):
+    """Merge the final states of the workers into one state.
+
+    `results` holds, per worker, its state and the input position of each
+    record it processed, by stream. Every worker starts from the bookmarks of
+    the `incoming` state, which are kept once: the bookmarks each worker added
+    are put back in input order after them. The summaries, which only count
+    the current run, are added up.
+    """
+    incoming = incoming or {}
+    merged = {key: copy.deepcopy(value) for key, value in incoming.items() if key != "summary"}
+    incoming_bookmarks = incoming.get("bookmarks") or {}
+    bookmarks = {}
+    for worker, (state, positions) in enumerate(results):
+        for key, value in state.items():
+            if key == "bookmarks":
+                for stream, entries in value.items():
+                    if not isinstance(entries, list):
+                        merged.setdefault("bookmarks", {})[stream] = entries
+                        continue
+                    stream_positions = positions.get(stream, [])
+                    entries = entries[len(incoming_bookmarks.get(stream) or []):]
+                    for index, entry in enumerate(entries):
+                        # entries without a matching record (e.g. batch errors) go last
+                        position = stream_positions[index] if index < len(stream_positions) else float("inf")
+                        bookmarks.setdefault(stream, []).append(((position, worker, index), entry))
+            elif key == "summary":
+                merged["summary"] = add_counts(merged.get("summary", {}), value)
+            else:
+                merged[key] = value
+    for stream, entries in bookmarks.items():
+        entries.sort(key=lambda entry: entry[0])
+        merged.setdefault("bookmarks", {}).setdefault(stream, []).extend(entry for _, entry in entries)
+    return merged
+
+
+class ShardedRun:
+    """Partitions the Singer input over `workers` target processes.
+
+    SCHEMA messages go to every worker and RECORD messages are hash-partitioned
+    by `shard_key`. Every worker gets the config files and the incoming state
+    file. Master data streams are written by a first generation of workers
+    and the other streams by a second one, so lookups in the second phase
+    find the entities created in the first. Each worker gets its own sinks;
+    the token is shared through the config file and the rate limit through
+    Exact's rate limit headers.
+
+    When a worker fails, the others are still waited for and the merged
+    state of the ones that finished is emitted before the run fails, so
+    their writes are not repeated by the next run.
+    """
+
+    def __init__(self, target, workers):
+        self.target = target
+        self.workers = workers
+        self.key_properties = {}
+        # per phase, per worker: spooled input and the input position of each record by stream
+        self.inputs = [[tempfile.TemporaryFile("w+") for _ in range(workers)] for _ in range(2)]
+        self.positions = [[{} for _ in range(workers)] for _ in range(2)]
+
+    def phase(self, stream):
+        if self.target.is_master_data(stream) or not self.target.config.get("defer_transactional_streams", False):
+            return 0
+        return 1
+
+    def write_all(self, line):
+        for inputs in self.inputs:
+            for worker_input in inputs:
+                worker_input.write(line)
+
+    def partition(self, file_input):
+        for position, line in enumerate(file_input):
+            if not line.strip():
+                continue
+            line = line if line.endswith("\n") else f"{line}\n"
+            message = loads(line)
+            if message["type"] == "SCHEMA":
+                self.key_properties[message["stream"]] = message.get("key_properties")
+            if message["type"] != "RECORD":
+                self.write_all(line)
+                continue
+
+            stream = message["stream"]
+            key = shard_key(message["record"], self.key_properties.get(stream), self.target.config.get("shard_key"))
+            if key is None:
+                worker = position % self.workers
+            else:
+                worker = zlib.crc32(json.dumps(key, default=str).encode()) % self.workers
+            phase = self.phase(stream)
+            self.inputs[phase][worker].write(line)
+            self.positions[phase][worker].setdefault(stream, []).append(position)
+
+    def run_phase(self, phase):
+        processes = []
+        for worker, worker_input in enumerate(self.inputs[phase]):
+            if not self.positions[phase][worker]:
+                continue
+            worker_input.flush()
+            worker_input.seek(0)
+            output = tempfile.TemporaryFile("w+")
+            command = [sys.executable, "-m", "target_exact.target"]
+            for config_file in self.target.config_files:
+                command += ["--config", str(config_file)]
+            if self.target.state_file:
+                command += ["--state", str(self.target.state_file)]
+            process = subprocess.Popen(
+                command,
+                stdin=worker_input,
+                stdout=output,
+                env={**os.environ, SHARD_ENV: str(worker)},
+                text=True,
+            )
+            processes.append((worker, process, output))
+
+        results, failed = [], []
+        for worker, process, output in processes:
+            if process.wait() != 0:
+                failed.append(f"{worker} (exit code {process.returncode})")
+                continue
+            output.seek(0)
+            # the target writes its state as bare JSON lines, the last one is final
+            state = {}
+            for line in output:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(message, dict):
+                    state = message
+            results.append((state, self.positions[phase][worker]))
+        return results, failed
+
+    def run(self, file_input):
+        self.target.logger.info(f"Running sharded over {self.workers} worker processes")
+        self.partition(file_input)
+        results, failed = self.run_phase(0)
+        if not failed:
+            # the second phase looks up what the first one wrote
+            phase_results, failed = self.run_phase(1)
+            results += phase_results
+        # written like the state of an unsharded run
+        self.target._write_state_message(merge_states(results, self.target._state))
+        if failed:
+            raise RuntimeError(f"Shard workers {', '.join(failed)} failed")
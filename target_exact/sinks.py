@@ -3,12 +3,12 @@
 
 import ast
 import base64
-import xmltodict
 import json
-from pendulum import parse
+from datetime import datetime
 
+from target_exact import tracing
 from target_exact.client import ExactSink
-from target_exact.constants import SALES_ORDER_STATUS, countries
+from target_exact.mapping import decode_lines, format_datetime
 from target_exact.exceptions import (
     InvalidOrderNumberError,
     MissingItemError,
@@ -21,6 +21,12 @@ class BuyOrdersSink(ExactSink):
 
     name = "BuyOrders"
     endpoint = "/purchaseorder/PurchaseOrders"
+    key_property = "PurchaseOrderID"
+    document_lines = ("PurchaseOrderLines", "/purchaseorder/PurchaseOrderLines", "PurchaseOrderID")
+    references = {
+        "Supplier": "/crm/Accounts",
+        "PurchaseOrderLines.Item": "/logistics/Items",
+    }
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
         if "line_items" not in record:
@@ -28,11 +34,10 @@ class BuyOrdersSink(ExactSink):
 
         receipt_date = record.get("created_at")
         if receipt_date:
-            receipt_date = parse(receipt_date) if isinstance(receipt_date, str) else receipt_date
-            receipt_date = receipt_date.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            receipt_date = format_datetime(receipt_date)
 
         payload = {
-            "OrderDate": record.get("transaction_date").strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "OrderDate": format_datetime(record.get("transaction_date")),
             "Supplier": record.get("supplier_remoteId"),
             "PurchaseOrderLines": [],
             "buy_order_remoteId": record.get("remoteId"),
@@ -44,8 +49,7 @@ class BuyOrdersSink(ExactSink):
         if receipt_date:
             payload["ReceiptDate"] = receipt_date
 
-        line_items = json.loads(record["line_items"])
-        for item in line_items:
+        for item in decode_lines(record["line_items"]):
             lot_size = item.get("lot_size") or 1
             qty = item.get("quantity") / lot_size
             line_item = {
@@ -69,6 +73,7 @@ class BuyOrdersSink(ExactSink):
                 id = record.get("buy_order_remoteId")
             else:
                 del record['buy_order_remoteId']
+                self.validate_references(record)
                 warehouse_uuid = self.config.get("warehouse_uuid")
                 if warehouse_uuid:
                     record["Warehouse"] = warehouse_uuid
@@ -81,14 +86,7 @@ class BuyOrdersSink(ExactSink):
                             {"error": "Warehouse uuid missing in config file"}
                         )
                         raise e
-                response = self.request_api(
-                    "POST", endpoint=endpoint, request_data=record
-                )
-                self.logger.info(f"response from api: {response.text}")
-                res_json = xmltodict.parse(response.text)
-                id = res_json["entry"]["content"]["m:properties"]["d:PurchaseOrderID"][
-                    "#text"
-                ]
+                id = self.create_document(endpoint, record)
                 self.logger.info(f"{self.name} created with id: {id}")
 
             self.logger.info(f"Returning {id}, True, {state_updates}")
@@ -96,18 +94,105 @@ class BuyOrdersSink(ExactSink):
 
 
 class UpdateInventory(ExactSink):
-    endpoint = "update_inventory"
+    """Exact Online inventory sink.
+
+    Quantity rows are aggregated per warehouse and posted as StockCounts,
+    so a run costs one request per `inventory_batch_size` items instead of
+    one request per row. A row is bookmarked as failed until the StockCount
+    holding it is created.
+    """
+
     name = "UpdateInventory"
-    endpoint = "UpdateInventory"
+    endpoint = "/inventory/StockCounts"
+    key_property = "StockCountID"
 
-    def preprocess_record(self, record: dict, context: dict) -> None:
-        return {}
+    def __init__(self, target, stream_name, schema, key_properties) -> None:
+        super().__init__(target, stream_name, schema, key_properties)
+        # {warehouse_id: {item_id: quantity}}, the last row for an item wins
+        self.pending_counts = {}
+        # {warehouse_id: [bookmark]} of the rows in pending_counts
+        self.pending_rows = {}
 
-    def upsert_record(self, record: dict, context: dict) -> None:
-        state_updates = dict()
-        id = "id"
-        return id, True, state_updates
+    @property
+    def batch_size(self) -> int:
+        return int(self.config.get("inventory_batch_size", 500))
+
+    def preprocess_record(self, record: dict, context: dict) -> dict:
+        operation = record.get("operation") or "set"
+        if operation != "set":
+            # stock counts record absolute quantities
+            return {"error": f"Unsupported inventory operation '{operation}' for SKU {record.get('sku')}"}
+
+        item_id = record.get("product_remoteId") or record.get("product_id")
+        if not item_id and record.get("sku"):
+            item_id = self.get_index("/logistics/Items", ["Code"]).get("Code", record["sku"])
+        if not item_id:
+            return {"error": f"Item not found for SKU {record.get('sku')}"}
+
+        warehouse_id = (
+            record.get("warehouse_remoteId")
+            or self.config.get("warehouse_uuid")
+            or self.default_warehouse_uuid
+        )
+        if not warehouse_id:
+            return {"error": "Warehouse uuid missing in record and config file"}
+
+        return {
+            "Warehouse": warehouse_id,
+            "Item": item_id,
+            "QuantityNew": record.get("quantity"),
+        }
 
+    def upsert_record(self, record: dict, context: dict) -> tuple:
+        if record.get("error"):
+            raise Exception(record["error"])
+
+        counts = self.pending_counts.setdefault(record["Warehouse"], {})
+        counts[record["Item"]] = record["QuantityNew"]
+        # settled once the warehouse's StockCount is posted
+        return record["Item"], False, {"pending": True, "warehouse": record["Warehouse"]}
+
+    def write_record(self, record: dict, context: dict) -> None:
+        super().write_record(record, context)
+        bookmark = self.latest_state["bookmarks"][self.name][-1]
+        if bookmark.get("pending"):
+            warehouse_id = bookmark["warehouse"]
+            self.pending_rows.setdefault(warehouse_id, []).append(bookmark)
+            if len(self.pending_counts[warehouse_id]) >= self.batch_size:
+                self.post_stock_count(warehouse_id)
+
+    def post_stock_count(self, warehouse_id):
+        counts = self.pending_counts.pop(warehouse_id, None)
+        rows = self.pending_rows.pop(warehouse_id, [])
+        if not counts:
+            return
+        payload = {
+            "Warehouse": warehouse_id,
+            "StockCountDate": format_datetime(datetime.utcnow()),
+            "Description": self.config.get("inventory_description", "Inventory update"),
+            "Status": self.config.get("inventory_stock_count_status", 21),
+            "StockCountLines": [
+                {"Item": item_id, "QuantityNew": quantity}
+                for item_id, quantity in counts.items()
+            ],
+        }
+        try:
+            id = self.create_entity(self.endpoint, payload)
+        except Exception as e:
+            self.logger.exception(f"Failed to post stock count for warehouse {warehouse_id}")
+            for bookmark in rows:
+                del bookmark["pending"]
+                bookmark["error"] = str(e)
+            return
+        self.logger.info(f"{self.name} posted stock count {id} with {len(counts)} lines")
+        for bookmark in rows:
+            del bookmark["pending"]
+            self.settle_bookmark(bookmark, True, stock_count=id)
+
+    def flush(self) -> None:
+        super().flush()
+        for warehouse_id in list(self.pending_counts):
+            self.post_stock_count(warehouse_id)
 
 
 class SuppliersSink(ExactSink):
@@ -115,6 +200,8 @@ class SuppliersSink(ExactSink):
 
     name = "Suppliers"
     endpoint = "/crm/Accounts"
+    # fields compared against the existing Account in the diff sync mode
+    diff_fields = ["Name", "CodeAtSupplier", "Phone", "AddressLine1", "City", "State", "Country"]
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
         if record.get("division") and not self.current_division:
@@ -143,6 +230,8 @@ class SuppliersSink(ExactSink):
 
                 country = record_address.get("country")
                 if country:
+                    from target_exact.constants import countries
+
                     if len(country) == 2:
                         payload["Country"] = country
                     elif country in countries.keys():
@@ -154,11 +243,11 @@ class SuppliersSink(ExactSink):
         """Process the record."""
         state_updates = dict()
         if record:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
+            if self.config.get("sync_mode") == "diff":
+                id, state_updates = self.diff_upsert(record, ["CodeAtSupplier", "Name"], self.diff_fields)
+                return id, True, state_updates
+            id = self.create_entity(self.endpoint, record)
+            self.remember_entity(self.endpoint, {"ID": id, **record})
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
 
@@ -168,6 +257,8 @@ class ItemsSink(ExactSink):
 
     name = "products"
     endpoint = "/logistics/Items"
+    # fields compared against the existing Item in the diff sync mode
+    diff_fields = ["Description", "ExtraDescription", "Code", "AverageCost"]
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
 
@@ -187,11 +278,11 @@ class ItemsSink(ExactSink):
         """Process the record."""
         state_updates = dict()
         if record:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
+            if self.config.get("sync_mode") == "diff":
+                id, state_updates = self.diff_upsert(record, ["Code"], self.diff_fields)
+                return id, True, state_updates
+            id = self.create_entity(self.endpoint, record)
+            self.remember_entity(self.endpoint, {"ID": id, **record})
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
 
@@ -201,6 +292,7 @@ class PurchaseInvoicesSink(ExactSink):
 
     name = "PurchaseInvoices"
     endpoint = "/purchase/PurchaseInvoices"
+    lookup_fields = {"/crm/Accounts": ["Name"], "/logistics/Items": ["Description"]}
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
 
@@ -216,18 +308,9 @@ class PurchaseInvoicesSink(ExactSink):
             "Journal": record.get("journal"),
         }
 
-        supplier_endpoint = (
-            f"/crm/Accounts?$filter=Name eq '{record.get('supplierName')}'"
-        )
-        supplier = self.request_api("GET", endpoint=supplier_endpoint)
-        supplier_json = xmltodict.parse(supplier.text)
-        suppliers = supplier_json["feed"].get("entry")
-        if suppliers and len(suppliers):
-            if type(suppliers) is dict:
-                id = suppliers["content"]["m:properties"]["d:ID"]["#text"]
-            else:
-                id = suppliers[0]["content"]["m:properties"]["d:ID"]["#text"]
-            payload["Supplier"] = id
+        supplier_id = self.lookup_id("/crm/Accounts", "Name", record.get("supplierName"))
+        if supplier_id:
+            payload["Supplier"] = supplier_id
         else:
             return None
 
@@ -248,19 +331,10 @@ class PurchaseInvoicesSink(ExactSink):
                         "Amount": line.get("totalPrice"),
                     }
 
-                    product_endpoint = f"/logistics/Items?$filter=Description eq '{line.get('productName')}'"
-                    product = self.request_api("GET", endpoint=product_endpoint)
-                    product_json = xmltodict.parse(product.text)
-                    products = product_json["feed"].get("entry")
-                    if products and len(products):
-                        if type(products) is dict:
-                            id = products["content"]["m:properties"]["d:ID"]["#text"]
-                        else:
-                            id = products[0]["content"]["m:properties"]["d:ID"]["#text"]
-                        invoice_line["Item"] = id
+                    product_id = self.lookup_id("/logistics/Items", "Description", line.get("productName"))
+                    if product_id:
+                        invoice_line["Item"] = product_id
                         invoice_lines.append(invoice_line)
-                    else:
-                        pass
 
             payload["PurchaseInvoiceLines"] = invoice_lines
 
@@ -270,11 +344,7 @@ class PurchaseInvoicesSink(ExactSink):
         """Process the record."""
         state_updates = dict()
         if record:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
+            id = self.create_entity(self.endpoint, record)
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
 
@@ -283,6 +353,9 @@ class PurchaseEntriesSink(ExactSink):
 
     name = "PurchaseEntries"
     endpoint = "/purchaseentry/PurchaseEntries"
+    key_property = "EntryID"
+    document_lines = ("PurchaseEntryLines", "/purchaseentry/PurchaseEntryLines", "EntryID")
+    lookup_fields = {"/crm/Accounts": ["Name"], "/financial/GLAccounts": ["Description"]}
 
     def _create_document(self):
         # Creates a document for the journal entry
@@ -291,9 +364,7 @@ class PurchaseEntriesSink(ExactSink):
             "Type": "20",
         }
 
-        document = self.request_api("POST", endpoint="/documents/Documents", request_data=document_payload)
-        document_json = xmltodict.parse(document.text)
-        document_id = document_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
+        document_id = self.create_entity("/documents/Documents", document_payload, "ID")
         return document_id
 
     def _upload_attachment(self, attachment_name, attachment_id=None):
@@ -314,6 +385,11 @@ class PurchaseEntriesSink(ExactSink):
             self.logger.info(f"Attachment {attachment_name} is not a PDF file")
             return None
 
+        if self.explain:
+            self.explain.count("attachments")
+            self._create_document()
+            return self.create_entity("/documents/DocumentAttachments", {"FileName": attachment_name}, "ID")
+
         with open(f"{input_path}{attachment_name}", "rb") as f:
             attachment = f.read()
             attachment = base64.b64encode(attachment)
@@ -326,13 +402,9 @@ class PurchaseEntriesSink(ExactSink):
             "Document": new_document_id,
         }
 
-        attachment = self.request_api(
-            "POST", endpoint="/documents/DocumentAttachments",
-            request_data=attachment_payload
+        attachment_id = self.create_entity(
+            "/documents/DocumentAttachments", attachment_payload, "ID"
         )
-
-        attachment_json = xmltodict.parse(attachment.text)
-        attachment_id = attachment_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
         return attachment_id
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
@@ -347,7 +419,7 @@ class PurchaseEntriesSink(ExactSink):
             "Journal": record.get("journal"),
         }
         #get supplier id
-        supplier_id = self.get_id("/crm/Accounts", {"$filter": f"Name eq '{record.get('supplierName')}'"})
+        supplier_id = self.lookup_id("/crm/Accounts", "Name", record.get("supplierName"))
         if supplier_id:
             payload["Supplier"] = supplier_id
 
@@ -358,7 +430,7 @@ class PurchaseEntriesSink(ExactSink):
             if len(lines):
                 for line in lines:
                     #get gl account id
-                    account_id = self.get_id("/financial/GLAccounts", {"$filter": f"Description eq '{line.get('accountName')}'"})
+                    account_id = self.lookup_id("/financial/GLAccounts", "Description", line.get("accountName"))
                     if not account_id:
                         self.logger.info("skipping journal entry line due to missing or inexistent account name")
                         continue
@@ -374,18 +446,16 @@ class PurchaseEntriesSink(ExactSink):
         if record.get("attachments"):
             record["attachments"] = json.loads(record["attachments"])
             if len(record["attachments"]) > 0:
-                payload["Document"] = self._upload_attachment(record["attachments"][0]["name"], record["attachments"][0].get("id"))
+                attachment = record["attachments"][0]
+                with tracing.span("attachment upload", name=attachment["name"]):
+                    payload["Document"] = self._upload_attachment(attachment["name"], attachment.get("id"))
         return payload
 
     def upsert_record(self, record: dict, context: dict) -> None:
         """Process the record."""
         state_updates = dict()
         if record:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:EntryID"]["#text"]
+            id = self.create_document(self.endpoint, record)
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
 
@@ -394,8 +464,12 @@ class SalesOrdersSink(ExactSink):
 
     name = "SalesOrders"
     endpoint = "/salesorder/SalesOrders"
+    key_property = "OrderID"
+    lookup_fields = {"/crm/Accounts": ["Name"], "/logistics/Items": ["Code", "Description"]}
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
+        from target_exact.constants import SALES_ORDER_STATUS
+
         try:
             if record.get("division") and not self.current_division:
                 self.endpoint = f"{record.get('division')}/{self.endpoint}"
@@ -409,29 +483,25 @@ class SalesOrdersSink(ExactSink):
                 raise InvalidOrderNumberError(f"OrderNumber should be int. OrderID {order_id} and OrderNumber {order_number}")
             
             accounts_endpoint = '/crm/Accounts'
-            if not (ordered_by := self.get_id(accounts_endpoint, {"$filter": f"Name eq '{record.get('customer_name')}'"})):
+            if not (ordered_by := self.lookup_id(accounts_endpoint, "Name", record.get("customer_name"))):
                 raise InvalidOrderedByError(f"Customer Name {record.get('customer_name')} not found. " + \
                                             f"OrderID {order_id}, OrderNumber {order_number}")
 
             order_lines = []
             for item in record.get("line_items", [{}]):
                 
-                item_id = None
                 item_endpoint = "/logistics/Items"
 
-                product_id_filters = [
-                    {"$filter": f"Code eq '{item.get('sku')}'"},
-                    {"$filter": f"Code eq '{item.get('product_name')}'"},
-                    {"$filter": f"Description eq '{item.get('product_name')}'"},
+                product_id_lookups = [
+                    ("ID", item.get("product_id")),
+                    ("Code", item.get("sku")),
+                    ("Code", item.get("product_name")),
+                    ("Description", item.get("product_name")),
                 ]
 
-                product_id = item.get("product_id")
-                if product_id:
-                    product_id_filters.insert(0, {"$filter": f"ID eq guid'{product_id}'"})
-
                 item_id = None
-                for filter in product_id_filters:
-                    if item_id := self.get_id(item_endpoint, filter):
+                for field, value in product_id_lookups:
+                    if item_id := self.lookup_id(item_endpoint, field, value):
                         break
                 
                 if not item_id:
@@ -459,8 +529,8 @@ class SalesOrdersSink(ExactSink):
                 "OrderNumber": record.get("order_number"),
                 "AmountDiscount": record.get("total_discount"),
                 "Description": record.get("order_notes"),
-                "DeliverTo": self.get_id(accounts_endpoint, {"$filter": f"Name eq '{record.get('shipping_name')}'"}),
-                "InvoiceTo": self.get_id(accounts_endpoint, {"$filter": f"Name eq '{record.get('billing_name')}'"}),
+                "DeliverTo": self.lookup_id(accounts_endpoint, "Name", record.get("shipping_name")),
+                "InvoiceTo": self.lookup_id(accounts_endpoint, "Name", record.get("billing_name")),
                 "OrderedBy": ordered_by,
             }
             return payload
@@ -472,11 +542,7 @@ class SalesOrdersSink(ExactSink):
         if record:
             if record.get("error"):
                 raise Exception(record.get("error"))
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:OrderID"]["#text"]
+            id = self.create_entity(self.endpoint, record)
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
         
@@ -485,11 +551,15 @@ class SalesOrdersSink(ExactSink):
 class ShopOrdersSink(ExactSink):
     name = "ShopOrders"
     endpoint = "/manufacturing/ShopOrders"
+    references = {
+        "Item": "/logistics/Items",
+        "Warehouse": "/inventory/Warehouses",
+    }
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
         if record.get("division") and not self.current_division:
             self.endpoint = f"{record.get('division')}/{self.endpoint}"
-        
+
         payload = {
             "Item" : record.get("product_remoteId"),
             "PlannedQuantity" : record.get("plannedQuantity"),
@@ -500,7 +570,7 @@ class ShopOrdersSink(ExactSink):
         }
 
         if record.get("transaction_date"):
-            payload["EntryDate"] = record["transaction_date"].strftime("%Y-%m-%dT%H:%M:%S.%fZ") 
+            payload["EntryDate"] = format_datetime(record["transaction_date"])
 
         return payload
 
@@ -509,12 +579,9 @@ class ShopOrdersSink(ExactSink):
         state_updates = dict()
         if not record:
             raise Exception("No record to upsert")
+        self.validate_references(record)
         try:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            id = res_json["entry"]["content"]["m:properties"]["d:ID"]["#text"]
+            id = self.create_entity(self.endpoint, record)
             self.logger.info(f"{self.name} created with id: {id}")
             return id, True, state_updates
         except Exception as e:
@@ -526,15 +593,20 @@ class WarehouseTransfersSink(ExactSink):
 
     name = "WarehouseTransfers"
     endpoint = "/inventory/WarehouseTransfers"
+    key_property = "TransferID"
+    document_lines = ("WarehouseTransferLines", "/inventory/WarehouseTransferLines", "TransferID")
+    references = {
+        "WarehouseFrom": "/inventory/Warehouses",
+        "WarehouseTo": "/inventory/Warehouses",
+        "WarehouseTransferLines.Item": "/logistics/Items",
+    }
 
     def preprocess_record(self, record: dict, context: dict) -> dict:
         WarehouseTransferLines = []
 
         # Build basic payload
         payload = {
-            "EntryDate": record.get("transaction_date").strftime(
-                "%Y-%m-%dT%H:%M:%S.%fZ"
-            ),
+            "EntryDate": format_datetime(record.get("transaction_date")),
             "WarehouseFrom": record.get("warehouse_from_id"),
             "WarehouseTo": record.get("warehouse_to_id"),
             "WarehouseTransferLines": WarehouseTransferLines,
@@ -558,9 +630,7 @@ class WarehouseTransfersSink(ExactSink):
 
         # Process transfer lines
         if "line_items" in record:
-            record["line_items"] = json.loads(record["line_items"])
-
-            for item in record.get("line_items"):
+            for item in decode_lines(record["line_items"]):
                 line_item = {}
                 line_item["Item"] = item.get("product_remoteId")
                 line_item["Quantity"] = item.get("quantity")
@@ -583,12 +653,9 @@ class WarehouseTransfersSink(ExactSink):
         state_updates = dict()
         if not record:
             raise Exception("No record to upsert")
+        self.validate_references(record)
         try:
-            response = self.request_api(
-                "POST", endpoint=self.endpoint, request_data=record
-            )
-            res_json = xmltodict.parse(response.text)
-            transfer_id = res_json["entry"]["content"]["m:properties"]["d:TransferID"]["#text"]
+            transfer_id = self.create_document(self.endpoint, record)
             self.logger.info(f"{self.name} created with id: {transfer_id}")
             return transfer_id, True, state_updates
 
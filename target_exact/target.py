@@ -1,21 +1,41 @@
 """Exact target class."""
-from target_exact.sinks import (
-    BuyOrdersSink,
-    UpdateInventory,
-    ItemsSink,
-    PurchaseInvoicesSink,
-    SuppliersSink,
-    PurchaseEntriesSink,
-    SalesOrdersSink,
-    ShopOrdersSink,
-    WarehouseTransfersSink
-)
+import importlib
+import json
+import sys
+import tempfile
+from collections import Counter
 
 from target_hotglue.target import TargetHotglue
 from typing import List, Optional, Union
 from pathlib import PurePath
 
 
+# Sink classes in target_exact.sinks. The module (and the dependencies only the
+# sinks need) is imported when the first stream shows up, not on CLI startup;
+# so are the helper modules, imported by the methods that use them.
+SINK_CLASS_NAMES = [
+    "BuyOrdersSink",
+    "UpdateInventory",
+    "ItemsSink",
+    "PurchaseInvoicesSink",
+    "SuppliersSink",
+    "PurchaseEntriesSink",
+    "SalesOrdersSink",
+    "ShopOrdersSink",
+    "WarehouseTransfersSink",
+]
+
+
+class LazySinkTypes:
+    """Class attribute that imports the sink classes on first access."""
+
+    def __get__(self, instance, owner):
+        if "__abstractmethods__" not in vars(owner):
+            # ABCMeta looks SINK_TYPES up while it is still creating the class
+            return self
+        sinks = importlib.import_module("target_exact.sinks")
+        return [getattr(sinks, name) for name in SINK_CLASS_NAMES]
+
 
 class TargetExact(TargetHotglue):
     """Sample target for Exact."""
@@ -27,15 +47,207 @@ class TargetExact(TargetHotglue):
         validate_config: bool = True,
         state: str = None
     ) -> None:
-        self.config_file = config[0]
-        super().__init__(config, parse_env_config, validate_config)
+        from target_exact import tracing
+        from target_exact.lookups import SingleFlight
+        from target_exact.rate_limits import RateLimitGate
+        from target_exact.scheduler import STREAM_DEPENDENCIES, SharedStateLock, dependency_graph
+
+        self.config_files = config if isinstance(config, list) else [config]
+        self.config_file = self.config_files[0]
+        self.state_file = state
+        # bulk lookup indexes shared by all sinks, keyed by (base_url, endpoint)
+        self.lookup_indexes = {}
+        # shared latency stats for hedged lookups, set up by the sinks
+        self.hedger = None
+        # per division and endpoint, set up by the sinks
+        self.circuit_breakers = None
+        # adaptive limit on requests in flight, set up by the sinks
+        self.concurrency = None
+        self.rate_limits = RateLimitGate()
+        # HTTP connection pool shared by the sinks, created on first request
+        self.session = None
+        # identical lookups in flight on several threads share one request
+        self.in_flight = SingleFlight()
+        # payload validators compiled from $metadata, keyed by (host, service)
+        self.metadata = {}
+        # spooled records of the streams that depend on others, by stream
+        self.deferred_records = {}
+        # latest SCHEMA message of each stream, spooled ahead of its records
+        self.schema_messages = {}
+        self.master_data_seen = False
+        # held around the SDK's record processing, which replays and write
+        # pipelines run on several threads
+        self.shared_state = SharedStateLock()
+        super().__init__(config, parse_env_config, validate_config, state)
+        if int(self.config.get("shard_workers", 1)) <= 1:
+            # only sharded runs start from the incoming bookmarks, which their
+            # merged state keeps; other runs emit this run's bookmarks only
+            self._state = {}
+        self.stream_dependencies = dependency_graph(STREAM_DEPENDENCIES, self.config.get("stream_dependencies"))
+        tracing.configure(self.config.get("trace_path"))
+        self.explain = None
+        if self.config.get("dry_run"):
+            from target_exact.explain import ExplainPlan
+
+            self.explain = ExplainPlan(
+                minutely_limit=int(self.config.get("rate_limit_minutely", 60)),
+                daily_limit=int(self.config.get("rate_limit_daily", 5000)),
+            )
+
+    def listen(self, file_input=None) -> None:
+        from target_exact.sharding import ShardedRun, is_shard_worker
+
+        workers = int(self.config.get("shard_workers", 1))
+        if workers > 1 and not is_shard_worker():
+            ShardedRun(self, workers).run(file_input or sys.stdin)
+            return
+        super().listen(file_input)
+
+    def deserialize_json(self, line: str) -> dict:
+        # newer singer-sdk readers decode each input line through this hook
+        from target_exact.messages import loads
+
+        return loads(line)
+
+    def _process_lines(self, file_input) -> Counter:
+        # singer-sdk 0.9 decodes the input with json.loads itself, so the
+        # lines are read here to decode them through deserialize_json
+        handlers = {
+            "SCHEMA": self._process_schema_message,
+            "RECORD": self._process_record_message,
+            "ACTIVATE_VERSION": self._process_activate_version_message,
+            "STATE": self._process_state_message,
+        }
+        self.logger.info(f"Target '{self.name}' is listening for input from tap.")
+        counter = Counter()
+        for line in file_input:
+            try:
+                message = self.deserialize_json(line)
+            except ValueError:
+                self.logger.error(f"Unable to parse:\n{line}")
+                raise
+            self._assert_line_requires(message, requires={"type"})
+            handlers.get(message["type"], self._process_unknown_message)(message)
+            counter[message["type"]] += 1
+        self.logger.info(
+            f"Target '{self.name}' completed reading {sum(counter.values())} lines of input "
+            f"({counter['RECORD']} records, {counter['STATE']} state messages)."
+        )
+        return counter
+
+    def is_master_data(self, stream_name: str) -> bool:
+        """Whether the stream depends on no other stream, and is written as it comes in."""
+        return not self.stream_dependencies.get(stream_name.lower())
+
+    def _process_record_message(self, message_dict: dict) -> None:
+        stream = message_dict["stream"]
+        if self.is_master_data(stream):
+            self.master_data_seen = True
+        elif self.config.get("defer_transactional_streams", False):
+            # spool to disk, replayed once the streams it depends on are written
+            if stream not in self.deferred_records:
+                self.deferred_records[stream] = tempfile.TemporaryFile("w+")
+                self.deferred_records[stream].write(json.dumps(self.schema_messages[stream]) + "\n")
+            self.deferred_records[stream].write(json.dumps(message_dict) + "\n")
+            return
+        self.process_record_message(message_dict)
 
+    def _process_schema_message(self, message_dict: dict) -> None:
+        stream = message_dict["stream"]
+        self.schema_messages[stream] = message_dict
+        if stream in self.deferred_records:
+            # the records spooled from here on are replayed with this schema
+            self.deferred_records[stream].write(json.dumps(message_dict) + "\n")
+        super()._process_schema_message(message_dict)
 
-    SINK_TYPES = [BuyOrdersSink, UpdateInventory, ItemsSink, PurchaseInvoicesSink, SuppliersSink, PurchaseEntriesSink, SalesOrdersSink, ShopOrdersSink, WarehouseTransfersSink]
+    def process_record_message(self, message_dict: dict) -> None:
+        from target_exact import tracing
+
+        # each record is the root span of its own trace
+        with tracing.span("record", stream=message_dict["stream"]), self.shared_state.held():
+            if self.explain:
+                record = message_dict.get("record") or {}
+                key = record.get("id") or record.get("remoteId") or record.get("sku")
+                with self.explain.record(message_dict["stream"], key):
+                    super()._process_record_message(message_dict)
+            else:
+                super()._process_record_message(message_dict)
+
+    def replay_stream(self, stream: str) -> None:
+        from target_exact.messages import loads
+
+        records = self.deferred_records.pop(stream)
+        records.seek(0)
+        for line in records:
+            message = loads(line)
+            if message["type"] == "SCHEMA":
+                # a new sink for the records spooled under another schema
+                with self.shared_state.held():
+                    super()._process_schema_message(message)
+            else:
+                self.process_record_message(message)
+        records.close()
+        # the streams depending on this one start once its records are written
+        with self.shared_state.held():
+            for sink in [*self._sinks_to_clear, self.get_sink(stream)]:
+                if sink.stream_name == stream:
+                    sink.flush()
+
+    def drain_all(self, is_endofpipe: bool = False) -> None:
+        # the SDK copies the state before draining, and RecordSinks are never
+        # drained, so have the sinks finish the writes they hold back first
+        for sink in [*self._sinks_to_clear, *self._sinks_active.values()]:
+            if sink:
+                sink.flush()
+                if is_endofpipe and sink.dead_letters is not None:
+                    sink.retry_dead_letters()
+                self.merge_sink_state(sink)
+        super().drain_all(is_endofpipe)
+
+    def merge_sink_state(self, sink) -> None:
+        """Merge the state of `sink` as the SDK does after each record.
+
+        A pipelined write updates the sink's state after the SDK merged it,
+        e.g. the first write of a sink sets the state up.
+        """
+        if not sink.latest_state:
+            return
+        if not self._latest_state:
+            self._latest_state = sink.latest_state
+            return
+        for key in self._latest_state.keys():
+            self._latest_state[key].update(sink.latest_state.get(key) or dict())
+
+    def _write_state_message(self, state: dict) -> None:
+        if self.explain:
+            # the dry run wrote nothing, its bookmarks hold placeholder IDs
+            self.logger.info("Dry run, not emitting the target state")
+            return
+        super()._write_state_message(state)
+
+    def _process_endofpipe(self) -> None:
+        if self.deferred_records:
+            from target_exact.scheduler import StreamScheduler
+
+            if self.master_data_seen:
+                self.logger.info("Master data written, processing deferred records")
+                self.drain_all()
+            scheduler = StreamScheduler(
+                self.stream_dependencies,
+                max_workers=int(self.config.get("stream_concurrency", self.MAX_PARALLELISM)),
+            )
+            scheduler.run({stream: lambda stream=stream: self.replay_stream(stream) for stream in self.deferred_records})
+        super()._process_endofpipe()
+        if self.concurrency:
+            self.logger.info(f"Adaptive concurrency: {json.dumps(self.concurrency.summary())}")
+        if self.explain:
+            self.explain.write_report(self.logger, self.config.get("explain_path"))
+
+
+    SINK_TYPES = LazySinkTypes()
     MAX_PARALLELISM = 10
     name = "target-exact"
 
 
 if __name__ == "__main__":
     TargetExact.cli()
-
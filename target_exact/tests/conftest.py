@@ -0,0 +1,132 @@
+"""Fixtures running the target end to end against a fake Exact API."""
+
+import contextlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+
+import pytest
+
+
+def feed(*entities):
+    """An Atom feed of entities, given as IDs or as dicts of their properties."""
+    entries = []
+    for entity in entities:
+        if not isinstance(entity, dict):
+            entity = {"ID": entity}
+        properties = "".join(
+            f'<d:ID m:type="Edm.Guid">{value}</d:ID>' if name == "ID" else f"<d:{name}>{value}</d:{name}>"
+            for name, value in entity.items()
+        )
+        entries.append(f"<entry><content><m:properties>{properties}</m:properties></content></entry>")
+    return f"<feed><title>feed</title>{''.join(entries)}</feed>"
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.reason = ""
+        self.url = ""
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise Exception(f"{self.status_code} error")
+
+
+class FakeSession:
+    """Stands in for the `requests.Session` of the sinks, recording every request.
+
+    `handler(method, url, json)` may return a `FakeResponse` (or raise);
+    otherwise GETs find nothing and writes create an entity with a new GUID
+    under every key property.
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, headers=None, json=None, timeout=None):
+        with self.lock:
+            self.requests.append({"method": method, "url": url, "params": params, "headers": headers, "json": json})
+        response = self.handler(method, url, json) if self.handler else None
+        if response is not None:
+            return response
+        if method == "GET":
+            return FakeResponse(200, feed())
+        key = re.search(r"\(guid'([0-9a-fA-F-]+)'\)", url)
+        if key:
+            return FakeResponse(204)
+        properties = "".join(
+            f'<d:{name} m:type="Edm.Guid">{uuid.uuid4()}</d:{name}>'
+            for name in ["ID", "OrderID", "EntryID", "TransferID", "PurchaseOrderID", "StockCountID"]
+        )
+        return FakeResponse(201, f"<entry><content><m:properties>{properties}</m:properties></content></entry>")
+
+    def writes(self):
+        return [request for request in self.requests if request["method"] != "GET"]
+
+
+def schema_message(stream, properties):
+    return {
+        "type": "SCHEMA",
+        "stream": stream,
+        "schema": {"properties": {name: {"type": ["string", "number", "null"]} for name in properties}},
+        "key_properties": [],
+    }
+
+
+def messages(stream, records):
+    """The SCHEMA and RECORD messages of `records` of one stream."""
+    properties = dict.fromkeys(name for record in records for name in record)
+    return [
+        schema_message(stream, properties),
+        *({"type": "RECORD", "stream": stream, "record": record} for record in records),
+    ]
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    def write(**config):
+        path = tmp_path / "config.json"
+        path.write_text(json.dumps({
+            "access_token": "token",
+            "refresh_token": "refresh",
+            "client_id": "client",
+            "client_secret": "secret",
+            "expires_in": int(time.time()) + 86400,
+            "current_division": "1",
+            **config,
+        }))
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def run_target(config_path):
+    """Run messages through a new target; returns the target and its state lines."""
+
+    def run(lines, session=None, state=None, **config):
+        from target_exact.target import TargetExact
+
+        target = TargetExact(config=[config_path(**config)], state=state)
+        target.session = session or FakeSession()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            target.listen(io.StringIO("".join(json.dumps(line) + "\n" for line in lines)))
+        return target, [json.loads(line) for line in output.getvalue().splitlines() if line.strip()]
+
+    return run
@@ -0,0 +1,89 @@
+"""Tests for the per-endpoint circuit breakers."""
+
+import time
+
+import pytest
+from singer_sdk.exceptions import RetriableAPIError
+
+from target_exact.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers
+from target_exact.exceptions import CircuitOpenError
+from target_exact.tests.conftest import FakeResponse, FakeSession
+
+
+def test_opens_on_failure_rate_and_recovers():
+    breaker = CircuitBreaker("/documents/DocumentAttachments", failure_rate=0.5, min_calls=4, open_seconds=0.05)
+    for success in [True, False, True]:
+        breaker.allow()
+        breaker.record(success)
+    assert breaker.state == CLOSED
+    breaker.record(False)
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.allow()
+    assert 0 < error.value.retry_after <= 0.05
+
+    time.sleep(0.06)
+    # one trial request at a time while half-open
+    breaker.allow()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record(False)
+    assert breaker.state == OPEN
+
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CLOSED
+    breaker.allow()
+
+
+def test_one_breaker_per_division_and_endpoint():
+    breakers = CircuitBreakers()
+    accounts = breakers.get("https://start.exactonline.nl/api/v1/1", "/crm/Accounts")
+    assert breakers.get("https://start.exactonline.nl/api/v1/1", "/crm/Accounts(guid'1')") is accounts
+    assert breakers.get("https://start.exactonline.nl/api/v1/2", "/crm/Accounts") is not accounts
+
+
+def test_sink_requests_fail_fast_while_the_circuit_is_open(run_target):
+    endpoint = "/salesorder/SalesOrders"
+    healthy = False
+
+    def degraded(method, url, json):
+        if endpoint in url and not healthy:
+            return FakeResponse(503, "unavailable")
+
+    session = FakeSession(degraded)
+    target, _ = run_target(
+        [], session, circuit_breaker=True, circuit_min_calls=2, circuit_window=2, circuit_open_seconds=0.05
+    )
+    sink = target.get_sink_class("ShopOrders")(target, "ShopOrders", {"properties": {}}, [])
+    breaker = target.circuit_breakers.get(sink.base_url, endpoint)
+
+    for _ in range(2):
+        with pytest.raises(RetriableAPIError):
+            sink._send_request("GET", endpoint)
+    assert breaker.state == OPEN
+    # not sent while open, other endpoints are unaffected
+    with pytest.raises(CircuitOpenError):
+        sink._send_request("GET", endpoint)
+    sink._send_request("GET", "/logistics/Items")
+    assert len(session.requests) == 3
+
+    # the half-open trial fails and opens the circuit again
+    time.sleep(0.06)
+    with pytest.raises(RetriableAPIError):
+        sink._send_request("GET", endpoint)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        sink._send_request("GET", endpoint)
+    assert len(session.requests) == 4
+
+    # the next trial succeeds and closes it
+    time.sleep(0.06)
+    healthy = True
+    assert sink._send_request("GET", endpoint).ok
+    assert breaker.state == CLOSED
+    sink._send_request("GET", endpoint)
+    assert len(session.requests) == 6
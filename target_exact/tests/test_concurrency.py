@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+
+from singer_sdk.exceptions import RetriableAPIError
+
+from target_exact.concurrency import AdaptiveConcurrency
+from target_exact.tests.conftest import FakeResponse, FakeSession
+
+
+def make_controller(**options):
+    # adjust on every request, the tests drive `record` directly
+    return AdaptiveConcurrency(**{"initial": 4, "interval": 0, "min_samples": 1, **options})
+
+
+def test_limit_grows_while_saturated_and_throughput_improves():
+    concurrency = make_controller()
+    # past slow start
+    concurrency.slow_start = False
+    concurrency.saturated = True
+    concurrency.adjust(10.0)
+    assert concurrency.limit == 5
+    # no gain from the extra slot, so no further increase
+    concurrency.saturated = True
+    concurrency.adjust(10.1)
+    assert concurrency.limit == 5
+    # nothing waited for a slot
+    concurrency.saturated = False
+    concurrency.adjust(20.0)
+    assert concurrency.limit == 5
+
+
+def test_limit_halves_on_throttling_and_errors():
+    concurrency = make_controller(initial=8)
+    concurrency.record("/salesorder/SalesOrders", 0.2, 429)
+    assert concurrency.limit == 4
+    concurrency.record("/salesorder/SalesOrders", 0.2, None)
+    assert concurrency.limit == 2
+    concurrency.record("/salesorder/SalesOrders", 0.2, 503)
+    assert concurrency.limit == 1
+    concurrency.record("/salesorder/SalesOrders", 0.2, 503)
+    assert concurrency.limit == 1
+    assert concurrency.summary()["decreases"] == {"throttled": 1, "errors": 2}
+
+
+def test_limit_decreases_on_latency_inflation():
+    concurrency = make_controller(initial=8)
+    concurrency.record("/logistics/Items", 0.1, 200)
+    concurrency.record("/crm/Accounts", 0.5, 200)
+    assert concurrency.limit == 8
+    # within tolerance of the baseline
+    concurrency.record("/logistics/Items", 0.15, 200)
+    assert concurrency.limit == 8
+    concurrency.record("/logistics/Items", 0.5, 200)
+    assert concurrency.limit == 6
+
+
+def test_changes_are_logged_as_metrics(caplog):
+    concurrency = make_controller(logger=logging.getLogger("test"))
+    with caplog.at_level(logging.INFO):
+        concurrency.record("/crm/Accounts(guid'1')", 0.1, 429)
+    [message] = caplog.messages
+    assert message.startswith("METRIC: ")
+    assert '"metric": "concurrency_limit"' in message
+    assert '"value": 2' in message
+    assert "1 throttled responses" in message
+
+
+def test_slot_caps_requests_in_flight():
+    concurrency = AdaptiveConcurrency(initial=2, interval=3600)
+    release = threading.Event()
+    peak = []
+
+    def request():
+        with concurrency.slot("/crm/Accounts") as outcome:
+            peak.append(concurrency.in_flight)
+            release.wait(1)
+            outcome["status"] = 200
+
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert max(peak) <= 2
+    assert concurrency.saturated
+    assert concurrency.stats["/crm/Accounts"].requests == 5
+
+
+def test_slow_start_doubles_the_limit_up_to_the_parallelism():
+    concurrency = AdaptiveConcurrency(max_limit=10, interval=0.02)
+    assert concurrency.limit == 1
+
+    def requests():
+        for _ in range(20):
+            with concurrency.slot("/crm/Accounts") as outcome:
+                time.sleep(0.01)
+                outcome["status"] = 200
+
+    threads = [threading.Thread(target=requests) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert concurrency.limit == 10
+    assert [new for _, new, _ in concurrency.changes] == [2, 4, 8, 10]
+
+
+def test_limit_grows_by_one_after_the_first_decrease():
+    concurrency = make_controller()
+    concurrency.saturated = True
+    concurrency.adjust(10.0)
+    assert concurrency.limit == 8
+    concurrency.record("/crm/Accounts", 0.1, 429)
+    assert concurrency.limit == 4
+    concurrency.saturated = True
+    concurrency.last_throughput = 10.0
+    concurrency.adjust(20.0)
+    assert concurrency.limit == 5
+
+
+def test_throttled_sink_requests_reduce_the_requests_in_flight(run_target):
+    lock = threading.Lock()
+    throttled = False
+    in_flight = []
+    peak = []
+
+    def api(method, url, json):
+        with lock:
+            in_flight.append(url)
+            peak.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.pop()
+        if throttled:
+            return FakeResponse(429, "Too many requests")
+
+    target, _ = run_target(
+        [], FakeSession(api), adaptive_concurrency=True, initial_concurrency=8, max_concurrency=8, concurrency_interval=0
+    )
+    sink = target.get_sink_class("ShopOrders")(target, "ShopOrders", {"properties": {}}, [])
+
+    def requests(count):
+        def send():
+            for _ in range(count):
+                try:
+                    sink._send_request("GET", "/logistics/Items")
+                except RetriableAPIError:
+                    pass
+
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sent, peak[:] = max(peak), []
+        return sent
+
+    assert requests(1) > 4
+    throttled = True
+    requests(3)
+    assert target.concurrency.limit == 1
+    throttled = False
+    assert requests(1) <= 2
+
+
+def test_sinks_start_at_the_min_concurrency(run_target):
+    target, _ = run_target([], adaptive_concurrency=True, min_concurrency=2)
+    target.get_sink_class("ShopOrders")(target, "ShopOrders", {"properties": {}}, [])
+    assert target.concurrency.limit == 2
+    assert target.concurrency.max_limit == target.MAX_PARALLELISM
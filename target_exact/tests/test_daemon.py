@@ -0,0 +1,66 @@
+"""Tests for the daemon's job isolation and cache eviction."""
+
+import io
+import json
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from target_exact.daemon import IndexCache, TargetDaemon, submit
+
+
+class FakeTarget:
+    """Echoes the number of records of a job as its state."""
+
+    SINK_TYPES = []
+    jobs = 0
+
+    def __init__(self, config):
+        self.lookup_indexes = self.rate_limits = self.in_flight = self.metadata = None
+        self.hedger = self.session = None
+
+    def listen(self, file_input):
+        FakeTarget.jobs += 1
+        if self.session is None:
+            self.session = object()
+        records = [json.loads(line) for line in file_input if line.strip()]
+        if any(record.get("fail") for record in records):
+            raise ValueError("bad input")
+        # like the SDK, the state is written as bare JSON; its text may mention the error type
+        sys.stdout.write(json.dumps({"records": len(records), "error": "DAEMON_ERROR"}) + "\n")
+
+
+def test_index_cache_eviction():
+    cache = IndexCache()
+    cache["a"], cache["b"], cache["c"] = [1] * 3, [1] * 3, [1] * 3
+    cache.get("a")
+    cache.evict(max_entities=6, max_age=60)
+    # b was the least recently used
+    assert list(cache) == ["c", "a"]
+    cache.loaded_at["c"] -= 120
+    cache.evict(max_entities=6, max_age=60)
+    assert list(cache) == ["a"]
+
+
+def test_jobs_over_socket():
+    path = os.path.join(tempfile.mkdtemp(), "daemon.sock")
+    daemon = TargetDaemon("config.json", target_class=FakeTarget)
+    threading.Thread(target=daemon.serve_socket, args=(path,), daemon=True).start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    outputs = []
+    for job in [b'{"id": 1}\n{"id": 2}\n', b'{"id": 3}\n']:
+        output = io.StringIO()
+        assert submit(path, io.BytesIO(job), output) == 0
+        outputs.append(json.loads(output.getvalue())["records"])
+    assert outputs == [2, 1]
+    assert submit(path, io.BytesIO(b'{"fail": true}\n'), io.StringIO()) == 1
+
+    # the session created by the first job is handed to the next ones
+    assert daemon.warm["session"] is not None
+    assert FakeTarget.jobs == 3
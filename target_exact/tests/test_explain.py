@@ -0,0 +1,37 @@
+"""Tests for the dry-run estimate."""
+
+import json
+
+from target_exact.tests.conftest import FakeSession, messages
+
+ORDERS = [
+    {"id": str(i), "product_remoteId": "06dbc452-3c12-437a-b987-3b959ead942a",
+     "warehouse_remoteId": "5f3165f8-dc27-4a95-8414-e50d8fd0edb9", "plannedQuantity": 1}
+    for i in range(2)
+]
+
+
+def test_dry_run_sends_nothing_and_emits_no_state(run_target, tmp_path):
+    explain_path = tmp_path / "explain.json"
+    session = FakeSession()
+    _, output = run_target(messages("ShopOrders", ORDERS), session, dry_run=True, explain_path=str(explain_path))
+
+    assert session.requests == []
+    assert output == []
+    report = json.loads(explain_path.read_text())
+    assert report["streams"]["ShopOrders"]["writes"] == 2
+    assert report["calls"]["warm"] == 2
+
+
+def test_projected_runtime_is_fractional(run_target, tmp_path):
+    explain_path = tmp_path / "explain.json"
+    run_target(
+        messages("ShopOrders", ORDERS), dry_run=True, explain_path=str(explain_path),
+        rate_limit_minutely=60, rate_limit_daily=5000,
+    )
+
+    # two calls are a fraction of a minute and of a day, not one of each
+    assert json.loads(explain_path.read_text())["projected_runtime"] == {
+        "minutes_at_minutely_limit": 0.0333,
+        "days_at_daily_limit": 0.0004,
+    }
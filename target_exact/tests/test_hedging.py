@@ -0,0 +1,71 @@
+"""Tests for hedged lookups and the token refresh timeout."""
+
+import itertools
+import json
+import math
+import time
+
+from target_exact.hedging import HedgedRequests
+from target_exact.tests.conftest import FakeResponse, FakeSession, feed, messages
+
+SUPPLIER = "887fce10-3be4-45bb-92a8-252b3e28c559"
+
+
+def test_hedges_are_capped_at_the_max_rate():
+    hedger = HedgedRequests(max_hedge_rate=0.1, min_samples=5)
+    # every slow request runs past the hedge delay, only the cap stops hedging
+    hedger.hedge_delay = lambda: 0.001
+    calls = itertools.count()
+
+    def fast():
+        next(calls)
+        return "fast"
+
+    def slow():
+        next(calls)
+        time.sleep(0.005)
+        return "slow"
+
+    for _ in range(5):
+        hedger.send(fast)
+    for _ in range(50):
+        hedger.send(slow)
+
+    # the cap is checked before each hedge, so it is reached but not passed
+    assert hedger.hedges == math.ceil(55 * 0.1)
+    assert next(calls) == 55 + hedger.hedges
+
+
+def test_slow_lookups_are_hedged_up_to_the_max_rate(run_target):
+    gets = itertools.count()
+
+    def slow_after_warm_up(method, url, json):
+        # the first lookups set the latency baseline, the rest are slower than its p95
+        if method == "GET":
+            if next(gets) >= 20:
+                time.sleep(0.01)
+            return FakeResponse(200, feed(SUPPLIER))
+
+    invoices = [{"id": str(i), "supplierName": f"supplier {i}"} for i in range(40)]
+    session = FakeSession(slow_after_warm_up)
+    target, _ = run_target(messages("PurchaseInvoices", invoices), session, hedge_lookups=True, hedge_max_rate=0.1)
+
+    lookups = [request for request in session.requests if request["method"] == "GET"]
+    assert target.hedger.requests == 40
+    assert 0 < target.hedger.hedges <= 4
+    assert len(lookups) == 40 + target.hedger.hedges
+
+
+def test_token_refresh_uses_the_post_timeout(run_target, monkeypatch):
+    import target_exact.auth
+
+    refreshes = []
+
+    def post(url, data=None, headers=None, timeout=None):
+        refreshes.append(timeout)
+        token = {"access_token": "new", "refresh_token": "new", "expires_in": 600}
+        return FakeResponse(200, json.dumps(token))
+
+    monkeypatch.setattr(target_exact.auth.requests, "post", post)
+    run_target(messages("products", [{"sku": "1", "name": "Chair"}]), expires_in=0, timeouts={"POST": [3, 30]})
+    assert refreshes == [(3, 30)]
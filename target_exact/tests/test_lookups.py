@@ -0,0 +1,162 @@
+"""Tests for the compact lookup index and coalesced lookups."""
+
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from target_exact.lookups import EntityIndex
+from target_exact.tests.conftest import FakeResponse, FakeSession, feed
+
+ENTITIES = [
+    {"ID": str(uuid.UUID(int=i + 1)), "Code": f"ITEM-{i}", "Description": f"Item number {i}"}
+    for i in range(5000)
+]
+
+
+def build_index():
+    index = EntityIndex(["Code", "Description"], complete=True)
+    for entity in ENTITIES:
+        index.add(entity)
+    return index
+
+
+def test_lookups():
+    index = build_index()
+    entity = ENTITIES[42]
+    assert len(index) == len(ENTITIES)
+    assert index.get("Code", " item-42 ") == entity["ID"]
+    assert index.get("Description", "ITEM NUMBER 42") == entity["ID"]
+    assert index.get("ID", entity["ID"].upper()) == entity["ID"].upper()
+    assert index.get("Code", "missing") is None
+    assert "not a guid" not in index
+    assert index.is_complete("Code") and not index.is_complete("Name")
+
+    # the first entity with a key wins
+    index.add({"ID": str(uuid.uuid4()), "Code": "ITEM-42"})
+    assert index.get("Code", "ITEM-42") == entity["ID"]
+
+
+def test_values():
+    index = EntityIndex(["Code"], ["Name"], complete=True)
+    index.add({"ID": ENTITIES[0]["ID"], "Code": "A", "Name": "old"})
+    values = index.get_values(ENTITIES[0]["ID"])
+    assert values.get("Name") == "old"
+    values.update({"Name": "new"})
+    assert index.get_values(ENTITIES[0]["ID"]).get("Name") == "new"
+
+
+def test_snapshot(tmp_path):
+    path = tmp_path / "items.idx"
+    build_index().save_snapshot(path)
+
+    assert EntityIndex.open_snapshot(path, ["Name"]) is None
+    assert EntityIndex.open_snapshot(path, ["Code"], max_age=-1) is None
+    index = EntityIndex.open_snapshot(path, ["Code"])
+    assert index.complete and len(index) == len(ENTITIES)
+    assert index.get("Code", "ITEM-7") == ENTITIES[7]["ID"]
+    assert ENTITIES[9]["ID"] in index
+
+    # entities created during the run go on top of the mapped snapshot
+    created = str(uuid.uuid4())
+    index.add({"ID": created, "Code": "NEW"})
+    assert index.get("Code", "new") == created
+    assert len(index) == len(ENTITIES) + 1
+
+
+def test_index_is_smaller_than_dicts():
+    tracemalloc.start()
+    index = build_index()
+    compact = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    # what the previous index kept: ID set and a dict of normalized keys per field
+    ids, keys = set(), {"Code": {}, "Description": {}}
+    for entity in ENTITIES:
+        ids.add(entity["ID"].lower())
+        for field, field_keys in keys.items():
+            field_keys.setdefault(entity[field].strip().lower(), entity["ID"])
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(index) == len(ids)
+    assert compact < baseline / 2
+
+
+def test_concurrent_adds_and_lookups():
+    index = EntityIndex(["Code"], complete=True)
+    barrier = threading.Barrier(8)
+
+    def add(worker):
+        barrier.wait()
+        for entity in ENTITIES[worker::4]:
+            index.add(entity)
+
+    def look_up(worker):
+        barrier.wait()
+        found = 0
+        for entity in ENTITIES[worker::4]:
+            id = index.get("Code", entity["Code"])
+            # a lookup racing the add may miss, but never returns another entity
+            assert id in (None, entity["ID"])
+            found += id is not None
+        return found
+
+    with ThreadPoolExecutor(8) as executor:
+        futures = [executor.submit(add, worker) for worker in range(4)]
+        futures += [executor.submit(look_up, worker) for worker in range(4)]
+        for future in futures:
+            future.result()
+
+    assert len(index) == len(ENTITIES)
+    for entity in ENTITIES:
+        assert index.get("Code", entity["Code"]) == entity["ID"]
+        assert index.get("Description", entity["Description"]) == entity["ID"]
+        assert entity["ID"] in index
+
+
+def concurrent_lookups(run_target, handler, values):
+    session = FakeSession(handler)
+    target, _ = run_target([])
+    target.session = session
+    sink = target.get_sink_class("SalesOrders")(target, "SalesOrders", {"properties": {}}, [])
+    # all threads start their lookup while the first one is in flight
+    barrier = threading.Barrier(len(values))
+
+    def lookup(value):
+        barrier.wait()
+        return sink.lookup_id("/logistics/Items", "Code", value)
+
+    with ThreadPoolExecutor(len(values)) as executor:
+        futures = [executor.submit(lookup, value) for value in values]
+    return session, futures
+
+
+def test_concurrent_identical_lookups_share_one_request(run_target):
+    def slow_items(method, url, json):
+        time.sleep(0.05)
+        return FakeResponse(200, feed(ENTITIES[0]["ID"]))
+
+    session, futures = concurrent_lookups(run_target, slow_items, ["ITEM-0"] * 8 + ["ITEM-1"] * 4)
+
+    assert [future.result() for future in futures] == [ENTITIES[0]["ID"]] * 12
+    assert sorted(request["params"]["$filter"] for request in session.requests) == [
+        "Code eq 'ITEM-0'", "Code eq 'ITEM-1'"
+    ]
+
+
+def test_concurrent_lookups_share_the_error(run_target):
+    def unavailable(method, url, json):
+        time.sleep(0.05)
+        return FakeResponse(400, "bad request")
+
+    session, futures = concurrent_lookups(run_target, unavailable, ["ITEM-0"] * 4)
+
+    for future in futures:
+        with pytest.raises(Exception):
+            future.result()
+    assert len(session.requests) == 1
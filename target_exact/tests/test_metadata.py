@@ -0,0 +1,134 @@
+"""Tests for the validators compiled from $metadata."""
+
+import pytest
+
+from target_exact.metadata import Property, compile_validators, parse_metadata
+from target_exact.tests.conftest import FakeResponse, FakeSession, feed
+
+ENTITY_SETS = {
+    "SalesOrders": (
+        [
+            Property("OrderID", "Edm.Guid", nullable=False, key=True),
+            Property("OrderedBy", "Edm.Guid"),
+            Property("Description", "Edm.String", max_length=10),
+            Property("OrderNumber", "Edm.Int32"),
+            Property("Status", "Edm.Int16", nullable=False),
+        ],
+        ["SalesOrderLines"],
+    ),
+    "SalesOrderLines": (
+        [Property("OrderID", "Edm.Guid"), Property("Item", "Edm.Guid"), Property("Quantity", "Edm.Double")],
+        ["SalesOrder"],
+    ),
+}
+
+ITEM = "06dbc452-3c12-437a-b987-3b959ead942a"
+
+METADATA = """<?xml version="1.0" encoding="utf-8"?>
+<edmx:Edmx Version="1.0" xmlns:edmx="http://schemas.microsoft.com/ado/2007/06/edmx">
+  <edmx:DataServices xmlns:m="http://schemas.microsoft.com/ado/2007/08/dataservices/metadata">
+    <Schema Namespace="Exact.Web.Api.Models" xmlns="http://schemas.microsoft.com/ado/2008/09/edm">
+      <EntityType Name="SalesOrder">
+        <Key><PropertyRef Name="OrderID"/></Key>
+        <Property Name="OrderID" Type="Edm.Guid" Nullable="false"/>
+        <Property Name="OrderedBy" Type="Edm.Guid"/>
+        <Property Name="Description" Type="Edm.String" MaxLength="10"/>
+        <NavigationProperty Name="SalesOrderLines" Relationship="r" FromRole="a" ToRole="b"/>
+      </EntityType>
+      <EntityType Name="SalesOrderLine">
+        <Key><PropertyRef Name="ID"/></Key>
+        <Property Name="ID" Type="Edm.Guid" Nullable="false"/>
+        <Property Name="OrderID" Type="Edm.Guid"/>
+        <Property Name="Item" Type="Edm.Guid"/>
+      </EntityType>
+      <EntityContainer Name="Container">
+        <EntitySet Name="SalesOrders" EntityType="Exact.Web.Api.Models.SalesOrder"/>
+        <EntitySet Name="SalesOrderLines" EntityType="Exact.Web.Api.Models.SalesOrderLine"/>
+      </EntityContainer>
+    </Schema>
+  </edmx:DataServices>
+</edmx:Edmx>
+"""
+
+
+def test_valid_payload():
+    validators = compile_validators(ENTITY_SETS)
+    line = {"OrderID": "source-order-1", "Item": ITEM, "Quantity": 2}
+    payload = {"OrderedBy": ITEM, "OrderNumber": "12", "SalesOrderLines": [line]}
+    # Exact fills in the document key of nested lines, appended lines need it
+    assert validators["SalesOrders"](payload, False) == []
+    assert validators["SalesOrderLines"](line, False) == ["OrderID: expected Edm.Guid, got 'source-order-1'"]
+
+
+def test_invalid_payload():
+    validate = compile_validators(ENTITY_SETS)["SalesOrders"]
+    payload = {
+        "OrderedBy": "unknown customer",
+        "Description": "longer than ten",
+        "Status": None,
+        "SalesOrderLines": [{"Item": None, "Quantity": "two"}],
+    }
+    assert validate(payload, False) == [
+        "OrderedBy: expected Edm.Guid, got 'unknown customer'",
+        "Description is longer than 10 characters",
+        "Status cannot be null",
+        "SalesOrderLines[0].Item is required",
+        "SalesOrderLines[0].Quantity: expected Edm.Double, got 'two'",
+    ]
+    assert validate({"OrderedBy": ITEM}, False) == ["SalesOrderLines is required"]
+
+
+def test_truncate():
+    validators = compile_validators(ENTITY_SETS, max_lengths={"SalesOrders": {"Description": 5}})
+    payload = {"OrderedBy": ITEM, "Description": "longer than ten", "SalesOrderLines": []}
+    assert validators["SalesOrders"](payload, True) == []
+    assert payload["Description"] == "longe"
+
+
+def test_parse_metadata():
+    pytest.importorskip("xmltodict")
+    entity_sets = parse_metadata(METADATA)
+    properties, navigation = entity_sets["SalesOrders"]
+    assert [(p.name, p.type, p.nullable, p.max_length, p.key) for p in properties] == [
+        ("OrderID", "Edm.Guid", False, None, True),
+        ("OrderedBy", "Edm.Guid", True, None, False),
+        ("Description", "Edm.String", True, 10, False),
+    ]
+    assert navigation == ["SalesOrderLines"]
+    assert [p.name for p in entity_sets["SalesOrderLines"][0]] == ["ID", "OrderID", "Item"]
+
+
+def test_invalid_records_are_not_posted(run_target):
+    pytest.importorskip("xmltodict")
+
+    def api(method, url, json):
+        if url.endswith("/$metadata"):
+            return FakeResponse(200, METADATA)
+        if method == "GET":
+            return FakeResponse(200, feed(ITEM))
+
+    orders = [
+        {"id": str(id), "order_number": id, "customer_name": "Chairs Inc", "order_notes": notes,
+         "line_items": [{"sku": "CH-1", "quantity": 1, "unit_price": 10}]}
+        for id, notes in [(1, "rush"), (2, "longer than ten")]
+    ]
+    schema = {
+        "type": "SCHEMA", "stream": "SalesOrders", "key_properties": [],
+        "schema": {"properties": {
+            **{name: {"type": ["string", "integer", "null"]} for name in ["id", "order_number", "customer_name", "order_notes"]},
+            "line_items": {"type": "array", "items": {"type": "object"}},
+        }},
+    }
+    session = FakeSession(api)
+    _, [state] = run_target(
+        [schema, *({"type": "RECORD", "stream": "SalesOrders", "record": order} for order in orders)],
+        session,
+        validate_payloads=True,
+    )
+
+    # the first order's lines carry its source ID as OrderID, which is not checked
+    [post] = session.writes()
+    assert post["json"]["YourRef"] == "1"
+    valid, invalid = state["bookmarks"]["SalesOrders"]
+    assert valid["success"] and not invalid["success"]
+    assert "Description is longer than 10 characters" in invalid["error"]
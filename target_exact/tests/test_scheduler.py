@@ -0,0 +1,54 @@
+"""Tests for the dependency-aware stream scheduler."""
+
+import threading
+import time
+
+import pytest
+
+from target_exact.scheduler import STREAM_DEPENDENCIES, StreamScheduler, dependency_graph
+
+
+def test_independent_streams_run_concurrently():
+    events = []
+    lock = threading.Lock()
+
+    def task(stream, duration):
+        def run():
+            with lock:
+                events.append(("start", stream))
+            time.sleep(duration)
+            with lock:
+                events.append(("end", stream))
+        return run
+
+    graph = dependency_graph(STREAM_DEPENDENCIES, {"ShopOrders": ["WarehouseTransfers"]})
+    start = time.monotonic()
+    StreamScheduler(graph, max_workers=4).run({
+        "WarehouseTransfers": task("WarehouseTransfers", 0.2),
+        "SalesOrders": task("SalesOrders", 0.2),
+        "ShopOrders": task("ShopOrders", 0.1),
+    })
+    elapsed = time.monotonic() - start
+
+    # the critical path is WarehouseTransfers -> ShopOrders, SalesOrders runs alongside
+    assert elapsed < 0.45
+    assert events.index(("end", "WarehouseTransfers")) < events.index(("start", "ShopOrders"))
+    assert events.index(("start", "SalesOrders")) < events.index(("end", "WarehouseTransfers"))
+
+
+def test_failed_stream_stops_its_dependents():
+    ran = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    graph = dependency_graph({"B": ["A"]})
+    with pytest.raises(RuntimeError):
+        StreamScheduler(graph, max_workers=2).run({"A": fail, "B": lambda: ran.append("B")})
+    assert ran == []
+
+
+def test_cycles_are_rejected():
+    graph = dependency_graph({"A": ["B"], "B": ["A"]})
+    with pytest.raises(ValueError, match="A -> B -> A"):
+        StreamScheduler(graph, max_workers=2).run({"A": lambda: None, "B": lambda: None})
@@ -0,0 +1,126 @@
+"""Tests for sharded runs, with real worker processes against a local fake API."""
+
+import http.server
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from target_exact.tests.conftest import FakeSession, messages
+
+ORDERS = [
+    {"id": str(i), "product_remoteId": "06dbc452-3c12-437a-b987-3b959ead942a",
+     "warehouse_remoteId": "5f3165f8-dc27-4a95-8414-e50d8fd0edb9", "plannedQuantity": 1}
+    for i in range(6)
+]
+
+INCOMING_STATE = {
+    "bookmarks": {"ShopOrders": [{"hash": "earlier", "success": True, "id": "earlier"}]},
+    "summary": {"ShopOrders": {"success": 1, "fail": 0, "existing": 0, "updated": 0}},
+}
+
+
+@pytest.fixture
+def api():
+    """An HTTP server answering like the fake session, recording the POSTed payloads."""
+    session = FakeSession()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def handle_request(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length)) if length else None
+            response = session.request(self.command, self.path, json=payload)
+            body = response.text.encode()
+            self.send_response(response.status_code)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = handle_request
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}", session
+    server.shutdown()
+
+
+def run_cli(config_path, state_path, lines):
+    result = subprocess.run(
+        [sys.executable, "-m", "target_exact.target", "--config", config_path, "--state", str(state_path)],
+        input="".join(json.dumps(line) + "\n" for line in lines),
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+    )
+    assert result.returncode == 0, result.stderr
+    return [json.loads(line) for line in result.stdout.splitlines() if line.strip()]
+
+
+def test_sharded_state_matches_an_unsharded_run(api, config_path, tmp_path):
+    pytest.importorskip("target_hotglue")
+    url, session = api
+    state_path = tmp_path / "state.json"
+    state_path.write_text(json.dumps(INCOMING_STATE))
+    lines = messages("ShopOrders", ORDERS)
+
+    [unsharded] = run_cli(config_path(auth_url=f"{url}/api/oauth2/token"), state_path, lines)
+    [sharded] = run_cli(config_path(auth_url=f"{url}/api/oauth2/token", shard_workers=3), state_path, lines)
+
+    # the same bare state, in input order; the sharded one keeps the incoming bookmark once
+    # and the summary only counts this run
+    assert sharded.keys() == unsharded.keys() == {"bookmarks", "summary"}
+    assert sharded["summary"] == unsharded["summary"] == {
+        "ShopOrders": {"success": 6, "fail": 0, "existing": 0, "updated": 0}
+    }
+    incoming, *entries = sharded["bookmarks"]["ShopOrders"]
+    assert incoming == INCOMING_STATE["bookmarks"]["ShopOrders"][0]
+    assert [entry["success"] for entry in entries] == [True] * 6
+    assert [entry["hash"] for entry in entries] == [entry["hash"] for entry in unsharded["bookmarks"]["ShopOrders"]]
+    posted = [request["json"]["YourRef"] for request in session.writes()]
+    assert sorted(posted) == sorted([order["id"] for order in ORDERS] * 2)
+
+
+def test_failed_worker_keeps_the_state_of_the_others(run_target, monkeypatch, capsys):
+    from target_exact import sharding
+
+    waited, sent = [], {}
+
+    class Worker:
+        """Writes a bookmark per record as its state; worker 1 fails."""
+
+        def __init__(self, command, stdin, stdout, env, text):
+            self.command = command
+            self.worker = int(env[sharding.SHARD_ENV])
+            records = [json.loads(line)["record"] for line in stdin if '"RECORD"' in line]
+            sent[self.worker] = [record["id"] for record in records]
+            assert command[-4:] == ["--config", "config.json", "--config", "secrets.json"]
+            self.returncode = 1 if self.worker == 1 else 0
+            stdout.write(json.dumps({"bookmarks": {"ShopOrders": [
+                {"hash": record["id"], "success": True} for record in records
+            ]}}) + "\n")
+
+        def wait(self):
+            waited.append(self.worker)
+            return self.returncode
+
+    target, _ = run_target([], shard_workers=3)
+    target.config_files = ["config.json", "secrets.json"]
+    monkeypatch.setattr(sharding.subprocess, "Popen", Worker)
+    run = sharding.ShardedRun(target, 3)
+    lines = "".join(json.dumps(line) + "\n" for line in messages("ShopOrders", ORDERS))
+    with pytest.raises(RuntimeError, match="Shard workers 1 "):
+        run.run(io.StringIO(lines))
+
+    # every worker is waited for, the bookmarks of the finished ones are emitted
+    assert sorted(waited) == [0, 1, 2]
+    [state] = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.strip()]
+    assert sent[1]
+    assert sorted(entry["hash"] for entry in state["bookmarks"]["ShopOrders"]) == sorted(sent[0] + sent[2])
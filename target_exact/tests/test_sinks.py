@@ -0,0 +1,383 @@
+"""Sink tests against a fake Exact API."""
+
+import json
+import time
+
+from target_exact.tests.conftest import FakeResponse, FakeSession, feed, messages
+
+INVENTORY = [
+    {"product_remoteId": f"item-{i}", "quantity": i, "warehouse_remoteId": "warehouse"}
+    for i in range(3)
+]
+
+
+def bookmarks(state, stream):
+    return state["bookmarks"][stream]
+
+
+def new_sink(run_target, stream, **config):
+    target, _ = run_target([], **config)
+    return target.get_sink_class(stream)(target, stream, {"properties": {}}, [])
+
+
+def test_inventory_partial_batch_is_posted(run_target):
+    session = FakeSession()
+    _, [state] = run_target(messages("UpdateInventory", INVENTORY), session, inventory_batch_size=2)
+
+    # one full batch and the remainder
+    posts = session.writes()
+    assert [len(post["json"]["StockCountLines"]) for post in posts] == [2, 1]
+    assert all(bookmark["success"] and "pending" not in bookmark for bookmark in bookmarks(state, "UpdateInventory"))
+    assert state["summary"]["UpdateInventory"] == {"success": 3, "fail": 0, "existing": 0, "updated": 0}
+
+
+def test_inventory_rows_fail_with_their_stock_count(run_target):
+    session = FakeSession(lambda method, url, json: FakeResponse(400, "bad request"))
+    _, [state] = run_target(messages("UpdateInventory", INVENTORY), session)
+
+    assert len(session.writes()) == 1
+    rows = bookmarks(state, "UpdateInventory")
+    assert [row["success"] for row in rows] == [False] * 3
+    assert all(row.get("error") for row in rows)
+    assert state["summary"]["UpdateInventory"]["fail"] == 3
+
+
+ITEM = "06dbc452-3c12-437a-b987-3b959ead942a"
+WAREHOUSE = "5f3165f8-dc27-4a95-8414-e50d8fd0edb9"
+
+
+def existing_entities(method, url, json):
+    # the entity sets the references are checked against
+    if method == "GET" and url.endswith("/logistics/Items"):
+        return FakeResponse(200, feed(ITEM))
+    if method == "GET" and url.endswith("/inventory/Warehouses"):
+        return FakeResponse(200, feed(WAREHOUSE))
+
+
+def test_unknown_references_are_quarantined(run_target, tmp_path):
+    quarantine_path = tmp_path / "quarantine.jsonl"
+    orders = [
+        {"id": "1", "product_remoteId": ITEM, "warehouse_remoteId": WAREHOUSE, "plannedQuantity": 1},
+        {"id": "2", "product_remoteId": "11111111-2222-3333-4444-555555555555",
+         "warehouse_remoteId": WAREHOUSE, "plannedQuantity": 1},
+    ]
+    session = FakeSession(existing_entities)
+    _, [state] = run_target(
+        messages("ShopOrders", orders), session,
+        validate_references=True, quarantine_path=str(quarantine_path),
+    )
+
+    # only the valid order is sent, each entity set is loaded once
+    assert [post["json"]["YourRef"] for post in session.writes()] == ["1"]
+    assert len([request for request in session.requests if request["method"] == "GET"]) == 2
+    assert [bookmark["success"] for bookmark in bookmarks(state, "ShopOrders")] == [True, False]
+    [quarantined] = [json.loads(line) for line in quarantine_path.read_text().splitlines()]
+    assert quarantined["record"]["YourRef"] == "2"
+    assert quarantined["error"].startswith("Item 11111111-2222-3333-4444-555555555555 does not exist")
+
+
+def test_diff_sync_skips_unchanged_items(run_target):
+    existing = {"ID": ITEM, "Description": "Chair", "ExtraDescription": "Oak", "Code": "CH-1", "AverageCost": "12.50"}
+
+    def items(method, url, json):
+        if method == "GET":
+            return FakeResponse(200, feed(existing))
+
+    products = [
+        {"sku": "CH-1", "name": "Chair", "description": "Oak", "cost": 12.5},
+        {"sku": "CH-1", "name": "Chair", "description": "Walnut", "cost": 12.5},
+        {"sku": "TB-1", "name": "Table", "description": "Oak", "cost": 80},
+    ]
+    session = FakeSession(items)
+    _, [state] = run_target(messages("products", products), session, sync_mode="diff")
+
+    # the unchanged item costs no request, the changed one only sends its change
+    writes = session.writes()
+    assert [(write["method"], write["json"]) for write in writes] == [
+        ("PUT", {"ExtraDescription": "Walnut"}),
+        ("POST", {"Description": "Table", "ExtraDescription": "Oak", "Code": "TB-1", "AverageCost": 80}),
+    ]
+    assert writes[0]["url"].endswith(f"/logistics/Items(guid'{ITEM}')")
+    assert len([request for request in session.requests if request["method"] == "GET"]) == 1
+    assert state["summary"]["products"] == {"success": 2, "fail": 0, "existing": 0, "updated": 1}
+
+
+def test_minimal_responses_read_the_key_from_location(run_target):
+    order_id = "9a3a6a38-4cde-4b3e-a1c1-7b1b6a0f0b55"
+
+    def created(method, url, json):
+        if method == "POST":
+            location = f"https://start.exactonline.nl/api/v1/1/manufacturing/ShopOrders(guid'{order_id}')"
+            return FakeResponse(201, "", {"Location": location})
+
+    order = {"id": "1", "product_remoteId": ITEM, "warehouse_remoteId": WAREHOUSE, "plannedQuantity": 1}
+    session = FakeSession(created)
+    _, [state] = run_target(messages("ShopOrders", [order]), session, minimal_responses=True)
+
+    [post] = session.writes()
+    assert post["headers"]["Prefer"] == "return=minimal"
+    [bookmark] = bookmarks(state, "ShopOrders")
+    assert bookmark["success"] and bookmark["id"] == order_id
+
+
+def test_minimal_response_without_a_key_fails_the_record(run_target):
+    def created(method, url, json):
+        if method == "POST":
+            return FakeResponse(204, "")
+
+    session = FakeSession(created)
+    _, [state] = run_target(messages("ShopOrders", [ORDER]), session, minimal_responses=True)
+
+    # created once, not POSTed again
+    assert len(session.writes()) == 1
+    [bookmark] = bookmarks(state, "ShopOrders")
+    assert not bookmark["success"]
+    assert "no key in a Location or DataServiceId header (status 204)" in bookmark["error"]
+
+
+def test_convert_datetime_keeps_whole_seconds(run_target):
+    from datetime import datetime
+
+    sink = new_sink(run_target, "products")
+    assert sink.convert_datetime(datetime(2022, 8, 15, 19, 16, 35, 120000)) == "2022-08-15T19:16:35Z"
+    assert sink.convert_datetime("2022-08-15") == "2022-08-15"
+
+
+ORDER = {"id": "1", "product_remoteId": ITEM, "warehouse_remoteId": WAREHOUSE, "plannedQuantity": 1}
+PRODUCT = {"sku": "CH-1", "name": "Chair"}
+
+
+def written_endpoints(session):
+    return [write["url"].rsplit("/", 1)[-1] for write in session.writes()]
+
+
+def test_streams_are_written_in_input_order_by_default(run_target):
+    session = FakeSession()
+    run_target([*messages("ShopOrders", [ORDER]), *messages("products", [PRODUCT])], session)
+    assert written_endpoints(session) == ["ShopOrders", "Items"]
+
+
+def test_deferred_records_are_replayed_with_their_schema(run_target, monkeypatch):
+    from target_exact.client import ExactSink
+
+    written = []
+    write_record = ExactSink.write_record
+
+    def spy(sink, record, context):
+        if sink.name == "ShopOrders":
+            written.append((record["YourRef"], sorted(sink.schema["properties"])))
+        write_record(sink, record, context)
+
+    monkeypatch.setattr(ExactSink, "write_record", spy)
+    second = {**ORDER, "id": "2", "description": "rush"}
+    session = FakeSession()
+    run_target(
+        [*messages("ShopOrders", [ORDER]), *messages("ShopOrders", [second]), *messages("products", [PRODUCT])],
+        session,
+        defer_transactional_streams=True,
+    )
+
+    # products first, then each order with the schema it was sent under
+    assert written_endpoints(session) == ["Items", "ShopOrders", "ShopOrders"]
+    assert written == [
+        ("1", sorted(ORDER)),
+        ("2", sorted(second)),
+    ]
+
+
+def test_dead_letters_are_retried_before_the_state_is_emitted(run_target, tmp_path):
+    posts = []
+
+    def unavailable_once(method, url, json):
+        if method == "POST":
+            posts.append(json["YourRef"])
+            if len(posts) == 1:
+                return FakeResponse(503, "unavailable")
+
+    session = FakeSession(unavailable_once)
+    _, [state] = run_target(
+        messages("ShopOrders", [ORDER]), session,
+        dead_letter_dir=str(tmp_path), dead_letter_retry_interval=0,
+    )
+
+    # one inline try, then the retry pass
+    assert posts == ["1", "1"]
+    [bookmark] = bookmarks(state, "ShopOrders")
+    assert bookmark["success"] and bookmark["retried"] and bookmark["hash"]
+    assert "deferred" not in bookmark and "error" not in bookmark
+    assert state["summary"]["ShopOrders"] == {"success": 1, "fail": 0, "existing": 0, "updated": 0}
+    assert (tmp_path / "ShopOrders.jsonl").read_text() == ""
+
+
+def test_dead_letters_are_retried_with_the_original_record(run_target, tmp_path):
+    posts = []
+
+    def unavailable_once(method, url, json):
+        if method == "POST":
+            posts.append(json)
+            if len(posts) == 1:
+                return FakeResponse(503, "unavailable")
+
+    order = {
+        "transaction_date": "2023-05-31T12:30:00Z",
+        "supplier_remoteId": ITEM,
+        "id": 7,
+        "line_items": json.dumps([{"product_remoteId": ITEM, "quantity": 1}]),
+    }
+    _, [state] = run_target(
+        messages("BuyOrders", [order]), FakeSession(unavailable_once),
+        dead_letter_dir=str(tmp_path), dead_letter_retry_interval=0, warehouse_uuid=WAREHOUSE,
+    )
+
+    # the sink drops buy_order_remoteId from the payload it sends
+    assert len(posts) == 2 and posts[0] == posts[1]
+    [bookmark] = bookmarks(state, "BuyOrders")
+    assert bookmark["success"] and bookmark["retried"]
+
+
+def test_requests_after_the_first_of_a_write_are_not_dead_lettered(run_target, tmp_path):
+    failed = []
+
+    def line_unavailable_once(method, url, json):
+        if url.endswith("/WarehouseTransferLines") and not failed:
+            failed.append(url)
+            return FakeResponse(503, "unavailable")
+
+    session = FakeSession(line_unavailable_once)
+    _, [state] = run_target(
+        messages("WarehouseTransfers", [TRANSFER]), session,
+        dead_letter_dir=str(tmp_path), max_lines_per_request=3,
+    )
+
+    # the header is written, so the line is retried inline rather than failing the document
+    [bookmark] = bookmarks(state, "WarehouseTransfers")
+    assert bookmark["success"] and "retried" not in bookmark
+    assert (tmp_path / "WarehouseTransfers.jsonl").read_text() == ""
+
+
+def test_pipelined_writes_are_in_the_state(run_target):
+    def slow_writes(method, url, json):
+        if method == "POST":
+            time.sleep(0.02)
+
+    orders = [{**ORDER, "id": str(i)} for i in range(5)]
+    _, [state] = run_target(messages("ShopOrders", orders), FakeSession(slow_writes), pipeline_depth=2)
+
+    assert [bookmark["success"] for bookmark in bookmarks(state, "ShopOrders")] == [True] * 5
+    assert state["summary"]["ShopOrders"]["success"] == 5
+
+
+def test_pipelined_state_of_a_one_record_stream_is_emitted(run_target):
+    _, [state] = run_target(messages("products", [PRODUCT]), FakeSession(), pipeline_depth=2)
+    assert [bookmark["success"] for bookmark in bookmarks(state, "products")] == [True]
+
+    products = [{**PRODUCT, "sku": f"CH-{i}"} for i in range(5)]
+    supplier = {"vendorName": "Chairs Inc", "vendorNumber": "1"}
+    _, [state] = run_target(
+        [*messages("products", products), *messages("Suppliers", [supplier])], FakeSession(), pipeline_depth=2
+    )
+    # the supplier's first write sets up its state after the SDK merged it
+    assert [bookmark["success"] for bookmark in bookmarks(state, "Suppliers")] == [True]
+    assert state["summary"]["Suppliers"]["success"] == 1
+    assert state["summary"]["products"]["success"] == 5
+
+
+def test_replayed_stream_is_written_before_its_dependents_start(run_target):
+    written = []
+
+    def slow_writes(method, url, json):
+        if method == "POST":
+            time.sleep(0.02)
+            written.append(url.rsplit("/", 1)[-1])
+
+    orders = [{**ORDER, "id": str(i)} for i in range(3)]
+    transfers = [{"id": "t", "transaction_date": "2024-01-01T00:00:00Z", "line_items": "[]"}]
+    run_target(
+        [*messages("ShopOrders", orders), *messages("WarehouseTransfers", transfers)],
+        FakeSession(slow_writes),
+        pipeline_depth=2,
+        defer_transactional_streams=True,
+        stream_dependencies={"WarehouseTransfers": ["ShopOrders"]},
+    )
+
+    assert written == ["ShopOrders"] * 3 + ["WarehouseTransfers"]
+
+
+def test_independent_streams_are_replayed_concurrently(run_target):
+    in_flight, overlaps = [], []
+
+    def slow_writes(method, url, json):
+        if method == "POST":
+            in_flight.append(url)
+            overlaps.append(len(in_flight))
+            time.sleep(0.02)
+            in_flight.remove(url)
+
+    orders = [{**ORDER, "id": str(i)} for i in range(10)]
+    transfers = [
+        {"id": f"t{i}", "description": f"transfer {i}", "transaction_date": "2024-01-01T00:00:00Z", "line_items": "[]"}
+        for i in range(10)
+    ]
+    _, [state] = run_target(
+        [*messages("ShopOrders", orders), *messages("WarehouseTransfers", transfers)],
+        FakeSession(slow_writes),
+        defer_transactional_streams=True,
+        stream_concurrency=2,
+    )
+
+    # the streams' requests overlap, their bookkeeping is not lost
+    assert max(overlaps) == 2
+    for stream in ["ShopOrders", "WarehouseTransfers"]:
+        assert [bookmark["success"] for bookmark in bookmarks(state, stream)] == [True] * 10
+        assert state["summary"][stream] == {"success": 10, "fail": 0, "existing": 0, "updated": 0}
+
+
+def test_split_lines_caps_lines_and_bytes(run_target):
+    lines = [{"Item": str(i)} for i in range(5)]
+    sink = new_sink(run_target, "WarehouseTransfers", max_lines_per_request=3)
+    assert sink.split_lines(lines) == (lines[:3], lines[3:])
+    assert sink.split_lines([]) == ([], [])
+
+    # each line is 13 bytes, the third goes over the byte cap
+    sink = new_sink(run_target, "WarehouseTransfers", max_request_bytes=30)
+    assert sink.split_lines(lines) == (lines[:2], lines[2:])
+    # a single line over the byte cap is still sent
+    big = [{"Item": "x" * 100}]
+    assert sink.split_lines(big) == (big, [])
+
+
+TRANSFER = {
+    "id": "t",
+    "transaction_date": "2023-05-31T12:30:00Z",
+    "warehouse_from_id": WAREHOUSE,
+    "warehouse_to_id": WAREHOUSE,
+    "line_items": json.dumps([{"product_remoteId": ITEM, "quantity": i} for i in range(1, 8)]),
+}
+
+
+def test_remaining_lines_are_appended_one_by_one(run_target):
+    session = FakeSession()
+    _, [state] = run_target(messages("WarehouseTransfers", [TRANSFER]), session, max_lines_per_request=3)
+
+    header, *appends = session.writes()
+    assert len(header["json"]["WarehouseTransferLines"]) == 3
+    # one entity per POST to the line entity set
+    assert [append["json"]["Quantity"] for append in appends] == [4, 5, 6, 7]
+    assert all(append["url"].endswith("/inventory/WarehouseTransferLines") for append in appends)
+    [bookmark] = bookmarks(state, "WarehouseTransfers")
+    assert all(append["json"]["TransferID"] == bookmark["id"] for append in appends)
+
+
+def test_failed_line_fails_the_document_without_resending_it(run_target):
+    def line_rejected(method, url, json):
+        if url.endswith("/WarehouseTransferLines") and len(session.writes()) == 4:
+            return FakeResponse(400, "bad line")
+
+    session = FakeSession(line_rejected)
+    _, [state] = run_target(messages("WarehouseTransfers", [TRANSFER]), session, max_lines_per_request=3)
+
+    # the header and first two appended lines are kept, the header is not POSTed again
+    assert len(session.writes()) == 4
+    [bookmark] = bookmarks(state, "WarehouseTransfers")
+    assert not bookmark["success"]
+    assert "was created with 5 of 7 lines" in bookmark["error"]
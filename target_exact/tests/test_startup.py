@@ -0,0 +1,44 @@
+"""Tests that the target CLI defers the imports only the sinks need."""
+
+import subprocess
+import sys
+
+import pytest
+
+# modules only the sinks and the optional features need, which must not be
+# imported on CLI startup (pendulum is not listed: singer_sdk imports it)
+LAZY_MODULES = [
+    "target_exact.sinks",
+    "target_exact.client",
+    "target_exact.constants",
+    "target_exact.explain",
+    "target_exact.lookups",
+    "target_exact.messages",
+    "target_exact.rate_limits",
+    "target_exact.scheduler",
+    "target_exact.sharding",
+    "target_exact.tracing",
+    "xmltodict",
+]
+
+
+def test_cli_import_is_lazy():
+    pytest.importorskip("target_hotglue")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import target_exact.target"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines look like "import time:       123 |       4567 | package.module"
+    imports = {line.split("|")[-1].strip() for line in result.stderr.splitlines()[1:]}
+
+    for module in LAZY_MODULES:
+        assert module not in imports, f"{module} is imported on startup"
+
+
+def test_sink_types_are_imported_on_first_access():
+    pytest.importorskip("target_hotglue")
+    from target_exact.target import SINK_CLASS_NAMES, TargetExact
+
+    assert [sink.__name__ for sink in TargetExact.SINK_TYPES] == SINK_CLASS_NAMES
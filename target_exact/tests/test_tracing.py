@@ -0,0 +1,54 @@
+"""Tests for the per-record traces."""
+
+import json
+
+from target_exact.tests.conftest import FakeResponse, FakeSession, messages
+
+ORDERS = [
+    {"id": str(i), "product_remoteId": "06dbc452-3c12-437a-b987-3b959ead942a",
+     "warehouse_remoteId": "5f3165f8-dc27-4a95-8414-e50d8fd0edb9", "plannedQuantity": 1}
+    for i in range(2)
+]
+
+
+def read_spans(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def attributes(span):
+    return {attribute["key"]: list(attribute["value"].values())[0] for attribute in span["attributes"]}
+
+
+def test_each_record_is_a_trace_of_its_requests(run_target, tmp_path):
+    def second_rejected(method, url, json):
+        if json and json.get("YourRef") == "1":
+            return FakeResponse(400, "bad request")
+
+    trace_path = tmp_path / "traces.jsonl"
+    run_target(
+        messages("ShopOrders", ORDERS), FakeSession(second_rejected),
+        trace_path=str(trace_path), pipeline_depth=2,
+    )
+
+    spans = read_spans(trace_path)
+    roots = [span for span in spans if span["name"] == "record"]
+    assert [attributes(root)["stream"] for root in roots] == ["ShopOrders"] * 2
+    assert all(root["parentSpanId"] == "" for root in roots)
+    assert len({root["traceId"] for root in roots}) == 2
+
+    # the POST written on the pipeline thread still belongs to its record's trace
+    posts = [span for span in spans if span["name"] == "HTTP POST"]
+    assert len(posts) == 2
+    for root, post in zip(roots, posts):
+        assert post["traceId"] == root["traceId"]
+        assert post["parentSpanId"] == root["spanId"]
+        assert post["startTimeUnixNano"] <= post["endTimeUnixNano"]
+    assert [attributes(post)["http.status_code"] for post in posts] == ["201", "400"]
+    assert [post["status"]["code"] for post in posts] == [1, 2]
+
+
+def test_tracing_is_off_by_default(run_target, tmp_path):
+    from target_exact import tracing
+
+    run_target(messages("ShopOrders", ORDERS[:1]))
+    assert tracing.tracer is None
@@ -0,0 +1,105 @@
+"""Opt-in per-record tracing, exported as OpenTelemetry-shaped JSONL spans."""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+current_span = contextvars.ContextVar("current_span", default=None)
+tracer = None
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+def attribute_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else ""
+        self.attributes = dict(attributes)
+        self.status = {"code": STATUS_OK}
+        self.start = time.time_ns()
+        self.end = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_span_id,
+            "name": self.name,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": [
+                {"key": key, "value": attribute_value(value)}
+                for key, value in self.attributes.items()
+                if value is not None
+            ],
+            "status": self.status,
+        }
+
+
+class Tracer:
+    """Appends finished spans, one JSON object per line, to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a")
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+
+def configure(path):
+    global tracer
+    if tracer is not None and tracer.path == path:
+        # e.g. the next job of the daemon
+        return
+    tracer = Tracer(path) if path else None
+
+
+@contextmanager
+def span(name, **attributes):
+    """Trace the block as a child of the current span (or as a new trace)."""
+    if tracer is None:
+        yield None
+        return
+    new_span = Span(name, current_span.get(), attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = {"code": STATUS_ERROR, "message": repr(e)}
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end = time.time_ns()
+        tracer.export(new_span)
+
+
+def add_span(name, duration, **attributes):
+    """Record a span starting now and lasting `duration` seconds, e.g. a retry sleep."""
+    if tracer is None:
+        return
+    new_span = Span(name, current_span.get(), attributes)
+    new_span.end = new_span.start + int(duration * 1e9)
+    tracer.export(new_span)